@@ -0,0 +1,424 @@
+#!/usr/bin/python2 -tt
+# -*- coding: utf-8 -*-
+
+###
+###  stats.bench.py
+###
+###  Times stats.parser.py stages on their own, over synthetic lines from
+###  stats.loggen.py, and compares results against a stored baseline
+###
+###  Usage:
+###
+###    $ stats.bench.py [options]
+###
+###  Help:
+###
+###    $ stats.bench.py -h
+###
+###
+###  Copyright 2016, MetaBrainz Foundation
+###  Author: Laurent Monin
+###
+###  stats.bench.py is free software: you can redistribute it and/or modify
+###  it under the terms of the GNU General Public License as published by
+###  the Free Software Foundation, either version 3 of the License, or
+###  (at your option) any later version.
+###
+###  stats.bench.py is distributed in the hope that it will be useful,
+###  but WITHOUT ANY WARRANTY; without even the implied warranty of
+###  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+###  GNU General Public License for more details.
+###
+###  You should have received a copy of the GNU General Public License
+###  along with stats.bench.py. If not, see <http://www.gnu.org/licenses/>.
+###
+
+
+from time import time
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+try:
+    import cPickle as pickle
+except:
+    import pickle
+try:
+    import tracemalloc
+except ImportError:
+    # python 2, peak memory isn't measured
+    tracemalloc = None
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_source(name, path):
+    """Imports a script whose file name isn't a valid module name, the module
+    is registered under name, so its objects can be pickled"""
+    try:
+        from importlib.util import module_from_spec, spec_from_file_location
+    except ImportError:
+        import imp
+        return imp.load_source(name, path)
+    spec = spec_from_file_location(name, path)
+    module = sys.modules[name] = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+sp = load_source('stats_parser', os.path.join(here, 'stats.parser.py'))
+loggen = load_source('stats_loggen', os.path.join(here, 'stats.loggen.py'))
+
+# benchmarks, in the order they are run, each one is a function taking the
+# bench context, and returning a function to time, returning the number of
+# items it handled, or None if it can't run here
+benchmarks = []
+
+
+def benchmark(unit):
+    def register(func):
+        benchmarks.append((func.__name__.replace('bench_', ''), unit, func))
+        return func
+    return register
+
+
+def copy(obj):
+    return pickle.loads(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+
+class Context(object):
+    """Generated log and data produced by each stage, so stages can be timed
+    on their own over the same input"""
+    def __init__(self, options, workdir):
+        self.options = options
+        self.workdir = workdir
+        self.logfile = os.path.join(workdir, 'stats.log')
+        self.lines = list(loggen.LogGenerator(options).lines(options.lines))
+        with open(self.logfile, 'w') as f:
+            for line in self.lines:
+                f.write(line + '\n')
+        self.status = self.new_status()
+        # all lines folded into buckets
+        self.storage = dict()
+        parser = sp.LineParser(self.storage, self.status['bucket_duration'])
+        parser.parse(self.lines)
+        self.hits = sum(sp.bucket_hits(acc) for acc in self.storage.values())
+        # all buckets processed
+        self.mbs = dict()
+        storage = copy(self.storage)
+        for bucket in sorted(storage):
+            sp.process_bucket(bucket, storage, self.status, self.mbs)
+
+    def new_status(self):
+        return {
+            'bucket_duration': sp.options.bucket_duration,
+            'lookback_factor': sp.options.lookback_factor,
+            'files': {
+                self.logfile: {
+                    'offset': None,
+                    'last_msec': 0,
+                    'leftover': dict(),
+                    'topk': dict((dimension, sp.TopK(size)) for dimension, size
+                                 in (('vhost', sp.options.max_vhosts),
+                                     ('upstream', sp.options.max_upstreams))
+                                 if size),
+                },
+            },
+        }
+
+
+@benchmark('lines')
+def bench_parsefile(ctx):
+    def run():
+        status = ctx.new_status()
+        tailer = sp.Tailer(ctx.logfile)
+        try:
+            filestatus = status['files'][ctx.logfile]
+            mbs, leftover, last_msec, parsed_lines, skipped_lines, late_lines = \
+                sp.parsefile(tailer, status, filestatus, sp.options)
+        finally:
+            tailer.close()
+        return parsed_lines
+    return run
+
+
+def parse_lines(ctx, engine, sample_rate=1):
+    """Returns a function parsing all lines by blocks, processing buckets"""
+    block = 10000
+    def run():
+        status = ctx.new_status()
+        parser = sp.LineParser(dict(), status['bucket_duration'],
+                               lookback_factor=status['lookback_factor'],
+                               mbs=dict(), status=status, engine=engine,
+                               sample_rate=sample_rate)
+        for start in range(0, len(ctx.lines), block):
+            parser.parse(ctx.lines[start:start + block])
+        return parser.parsed_lines
+    return run
+
+
+@benchmark('lines')
+def bench_parse(ctx):
+    return parse_lines(ctx, 'python')
+
+
+@benchmark('lines')
+def bench_parse_numpy(ctx):
+    if sp.numpy is None:
+        return None
+    return parse_lines(ctx, 'numpy')
+
+
+@benchmark('lines')
+def bench_parse_sampled(ctx):
+    # 1 line in 10, as when falling behind
+    return parse_lines(ctx, 'python', 10)
+
+
+@benchmark('rows')
+def bench_parse_upstreams(ctx):
+    rows = []
+    for line in ctx.lines:
+        items = line.split('|')
+        if ' ' in items[sp.pos_upstream_addr]:
+            rows.append({
+                'upstream_addr': items[sp.pos_upstream_addr],
+                'upstream_status': items[sp.pos_upstream_status],
+                'upstream_response_time': items[sp.pos_upstream_response_time],
+                'upstream_connect_time': items[sp.pos_upstream_connect_time],
+                'upstream_header_time': items[sp.pos_upstream_header_time],
+            })
+    def run():
+        parse_upstreams = sp.parse_upstreams
+        for row in rows:
+            parse_upstreams(row)
+        return len(rows)
+    return run
+
+
+@benchmark('lines')
+def bench_process_bucket(ctx):
+    storages = []
+    def setup():
+        storages.append(copy(ctx.storage))
+    def run():
+        storage = storages.pop()
+        mbs = dict()
+        for bucket in sorted(storage):
+            sp.process_bucket(bucket, storage, ctx.status, mbs)
+        return ctx.hits
+    run.setup = setup
+    return run
+
+
+@benchmark('lines')
+def bench_merge(ctx):
+    def run():
+        # every bucket into a single one, as catch-up and rollups do
+        acc = sp.Accumulator()
+        for bucket in ctx.storage:
+            acc.merge(ctx.storage[bucket])
+        return ctx.hits
+    return run
+
+
+@benchmark('points')
+def bench_encode(ctx):
+    def run():
+        encoder = sp.LineEncoder(sp.global_tags(sp.options),
+                                 sp.options.consolidated)
+        return len(encoder.encode(ctx.mbs, ctx.status))
+    return run
+
+
+@benchmark('commits')
+def bench_status_save(ctx):
+    path = os.path.join(ctx.workdir, 'bench.journal')
+    status = leftover_status(ctx)
+    def setup():
+        if os.path.exists(path):
+            os.unlink(path)
+    def run():
+        journal = sp.Journal(path)
+        journal.commit(sp.status2journal(status))
+        journal.close()
+        return 1
+    run.setup = setup
+    return run
+
+
+@benchmark('loads')
+def bench_status_load(ctx):
+    path = os.path.join(ctx.workdir, 'bench.journal')
+    if os.path.exists(path):
+        os.unlink(path)
+    journal = sp.Journal(path)
+    journal.commit(sp.status2journal(leftover_status(ctx)))
+    journal.close()
+    def run():
+        journal = sp.Journal(path)
+        sp.journal2status(journal.load())
+        journal.close()
+        return 1
+    return run
+
+
+def leftover_status(ctx):
+    """Returns status as saved at end of a run, with leftover buckets"""
+    status = ctx.new_status()
+    keep = status['lookback_factor'] + 1
+    leftover = dict((bucket, ctx.storage[bucket])
+                    for bucket in sorted(ctx.storage)[-keep:])
+    status['files'][ctx.logfile]['leftover'] = leftover
+    status['files'][ctx.logfile]['last_msec'] = float(ctx.lines[-1].split('|')[1])
+    return status
+
+
+def measure(run, repeat):
+    """Returns items handled, best duration over repeat runs, and peak memory
+    allocated during an extra run"""
+    setup = getattr(run, 'setup', None)
+    best = None
+    items = 0
+    for i in range(repeat):
+        if setup:
+            setup()
+        gc.collect()
+        start = time()
+        items = run()
+        duration = time() - start
+        if best is None or duration < best:
+            best = duration
+    peak = None
+    if tracemalloc is not None:
+        if setup:
+            setup()
+        gc.collect()
+        tracemalloc.start()
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return (items, best, peak)
+
+
+def run_benchmarks(options):
+    workdir = options.workdir or tempfile.mkdtemp(prefix='stats.bench.')
+    try:
+        sp.options = sp.parse_options(['-f', os.path.join(workdir, 'stats.log'),
+                                       '-w', workdir, '-q', '-q', '-q',
+                                       '--catchup-threshold', '0'])[1]
+        start = time()
+        ctx = Context(options, workdir)
+        logging.info("Generated %d lines in %.1fs" % (len(ctx.lines), time() - start))
+        results = dict()
+        for name, unit, func in benchmarks:
+            if options.only and name not in options.only:
+                continue
+            run = func(ctx)
+            if run is None:
+                logging.info("Skipping %s" % name)
+                continue
+            items, seconds, peak = measure(run, options.repeat)
+            results[name] = {
+                'items': items,
+                'unit': unit,
+                'seconds': seconds,
+                'rate': items / seconds if seconds else 0.0,
+                'peak_memory': peak,
+            }
+        return results
+    finally:
+        if not options.workdir:
+            shutil.rmtree(workdir)
+
+
+def bench_params(options):
+    """Returns what results depend on, besides code being benchmarked"""
+    params = dict((k, getattr(options, k)) for k in loggen.defaults if k != 'output')
+    params['python'] = platform.python_version()
+    return params
+
+
+def report(results, baseline, options):
+    """Prints results, compared to baseline if any, returns names of
+    benchmarks slower than baseline by more than tolerance"""
+    regressions = []
+    print("%-16s %10s %-8s %10s %12s %10s %8s" % ('benchmark', 'items', 'unit',
+                                                 'seconds', 'items/s',
+                                                 'peak KiB', 'change'))
+    for name, unit, func in benchmarks:
+        if name not in results:
+            continue
+        result = results[name]
+        peak = '-'
+        if result['peak_memory'] is not None:
+            peak = '%d' % (result['peak_memory'] / 1024)
+        change = ''
+        if name in baseline:
+            ratio = result['seconds'] / baseline[name]['seconds'] - 1
+            change = '%+.1f%%' % (100 * ratio)
+            if ratio > options.tolerance:
+                regressions.append(name)
+                change += ' !'
+        print("%-16s %10d %-8s %10.4f %12.0f %10s %8s" % (name, result['items'],
+                                                         result['unit'],
+                                                         result['seconds'],
+                                                         result['rate'], peak,
+                                                         change))
+    return regressions
+
+
+def parse_options(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Time stats.parser.py stages over synthetic lines")
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help="run each benchmark N times, best time is kept")
+    parser.add_argument('--only', action='append',
+                        choices=[name for name, unit, func in benchmarks],
+                        help="only run this benchmark, can be repeated")
+    parser.add_argument('-b', '--baseline',
+                        help="compare results with baseline saved in this json file")
+    parser.add_argument('--save-baseline',
+                        help="save results as baseline in this json file")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="exit with status 1 if a benchmark is slower than baseline by more than this ratio")
+    parser.add_argument('-w', '--workdir',
+                        help="directory for generated log and journals, a temporary one by default")
+    loggen.add_options(parser)
+    parser.set_defaults(lines=100000, start=1500000000.0, seed=1)
+    return parser.parse_args(argv)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    options = parse_options()
+    params = bench_params(options)
+
+    baseline = dict()
+    if options.baseline:
+        with open(options.baseline, 'r') as f:
+            saved = json.load(f)
+        if saved['params'] != params:
+            logging.warning("Baseline was measured with different parameters: %r" %
+                            saved['params'])
+        baseline = saved['results']
+
+    results = run_benchmarks(options)
+    regressions = report(results, baseline, options)
+
+    if options.save_baseline:
+        with open(options.save_baseline, 'w') as f:
+            json.dump({'params': params, 'results': results}, f, indent=2,
+                      sort_keys=True)
+    if regressions:
+        print("Slower than baseline: %s" % ', '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+#!/usr/bin/python2 -tt
+# -*- coding: utf-8 -*-
+
+###
+###  stats.loggen.py
+###
+###  Generates synthetic nginx stats log lines (format 1, see stats.parser.py
+###  -h), for testing and benchmarking stats.parser.py
+###
+###  Usage:
+###
+###    $ stats.loggen.py [options]
+###
+###  Help:
+###
+###    $ stats.loggen.py -h
+###
+###
+###  Copyright 2016, MetaBrainz Foundation
+###  Author: Laurent Monin
+###
+###  stats.loggen.py is free software: you can redistribute it and/or modify
+###  it under the terms of the GNU General Public License as published by
+###  the Free Software Foundation, either version 3 of the License, or
+###  (at your option) any later version.
+###
+###  stats.loggen.py is distributed in the hope that it will be useful,
+###  but WITHOUT ANY WARRANTY; without even the implied warranty of
+###  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+###  GNU General Public License for more details.
+###
+###  You should have received a copy of the GNU General Public License
+###  along with stats.loggen.py. If not, see <http://www.gnu.org/licenses/>.
+###
+
+
+from bisect import bisect
+from time import time
+import argparse
+import random
+import sys
+
+
+defaults = {
+    'lines': 100000,
+    'output': '-',
+    'start': 0,
+    'rate': 200.0,
+    'seed': 0,
+    'vhosts': 20,
+    'upstreams': 50,
+    'loctags': 3,
+    'upstream_ratio': 0.7,
+    'multi_upstream_ratio': 0.05,
+    'gzip_ratio': 0.4,
+    'disorder': 2.0,
+}
+
+
+def add_options(parser):
+    """Adds generator options to an argparse parser, so other tools can
+    expose them"""
+    group = parser.add_argument_group('Generator options')
+    group.add_argument('-n', '--lines', type=int,
+                       help="number of lines to generate")
+    group.add_argument('--start', type=float,
+                       help="timestamp of first line, 0 to end lines now")
+    group.add_argument('--rate', type=float,
+                       help="lines per second")
+    group.add_argument('--seed', type=int,
+                       help="random seed, same seed and options give same lines")
+    group.add_argument('--vhosts', type=int,
+                       help="number of distinct vhosts, hits follow a Zipf distribution")
+    group.add_argument('--upstreams', type=int,
+                       help="number of distinct upstream servers")
+    group.add_argument('--loctags', type=int,
+                       help="number of distinct location tags, besides '-'")
+    group.add_argument('--upstream-ratio', type=float,
+                       help="proportion of requests passed to an upstream")
+    group.add_argument('--multi-upstream-ratio', type=float,
+                       help="proportion of upstream requests contacting several servers or internally redirected")
+    group.add_argument('--gzip-ratio', type=float,
+                       help="proportion of gzipped responses")
+    group.add_argument('--disorder', type=float,
+                       help="lines are logged up to N seconds late, so msec is out of order")
+    parser.set_defaults(**defaults)
+    return group
+
+
+def zipf_weights(count):
+    """Returns cumulative weights of count values, first value is the most
+    frequent"""
+    cumulative = []
+    total = 0.0
+    for rank in range(1, count + 1):
+        total += 1.0 / rank
+        cumulative.append(total)
+    return cumulative
+
+
+class LogGenerator(object):
+    """Yields format 1 stats log lines (without end of line)
+
+    Lines are written at rate per second from start, each one with a msec
+    up to disorder seconds older than the time it was written at, as nginx
+    logs a request when it ends.
+    """
+    statuses = (200,) * 80 + (304,) * 8 + (301, 302) * 2 + (404,) * 4 + (500, 502)
+
+    def __init__(self, options):
+        self.random = random.Random(options.seed)
+        self.rate = options.rate
+        self.start = options.start
+        if not self.start:
+            self.start = time() - options.lines / options.rate
+        self.disorder = options.disorder
+        self.upstream_ratio = options.upstream_ratio
+        self.multi_upstream_ratio = options.multi_upstream_ratio
+        self.gzip_ratio = options.gzip_ratio
+        self.vhosts = ['vhost%d.example.org' % i for i in range(options.vhosts)]
+        self.vhost_weights = zipf_weights(options.vhosts)
+        self.upstreams = ['10.%d.%d.%d:80' % (i >> 16 & 255, i >> 8 & 255, i & 255)
+                          for i in range(options.upstreams)]
+        self.upstream_weights = zipf_weights(options.upstreams)
+        self.loctags = ['-'] * (options.loctags + 1) + ['loc%d' % i for i in range(options.loctags)]
+
+    def choice(self, values, weights):
+        return values[bisect(weights, self.random.random() * weights[-1])]
+
+    def upstream(self):
+        """Returns upstream address, status, response, connect and header
+        times of one server"""
+        rnd = self.random
+        response_time = rnd.lognormvariate(-3, 1)
+        connect_time = min(rnd.expovariate(1000), response_time)
+        header_time = connect_time + (response_time - connect_time) * rnd.random()
+        return (self.choice(self.upstreams, self.upstream_weights),
+                str(rnd.choice(self.statuses)),
+                '%.3f' % response_time, '%.3f' % connect_time,
+                '%.3f' % header_time)
+
+    def upstream_fields(self):
+        rnd = self.random
+        if rnd.random() >= self.upstream_ratio:
+            return ('-', ) * 5
+        if rnd.random() >= self.multi_upstream_ratio:
+            return self.upstream()
+        # servers contacted are separated by ', ', internal redirects by ' : '
+        first = self.upstream()
+        second = self.upstream()
+        if rnd.random() < 0.5:
+            # next server tried after an error, without a response header
+            first = (first[0], '502', first[2], first[3], '-')
+            separator = ', '
+        else:
+            separator = ' : '
+        return tuple(separator.join(values) for values in zip(first, second))
+
+    def lines(self, count):
+        rnd = self.random
+        for i in range(count):
+            msec = self.start + i / self.rate - rnd.random() * self.disorder
+            if rnd.random() < self.gzip_ratio:
+                gzip_ratio = '%.2f' % rnd.uniform(1, 8)
+            else:
+                gzip_ratio = '-'
+            upstream = self.upstream_fields()
+            if upstream[0] == '-':
+                request_time = rnd.lognormvariate(-6, 1)
+            else:
+                request_time = float(upstream[2].split(' ')[-1]) + rnd.expovariate(1000)
+            yield '1|%.3f|%s|%s|%s|%d|%d|%s|%d|%.3f|%s' % (
+                msec,
+                self.choice(self.vhosts, self.vhost_weights),
+                's' if rnd.random() < 0.8 else '-',
+                rnd.choice(self.loctags),
+                rnd.choice(self.statuses),
+                int(rnd.lognormvariate(8, 2)),
+                gzip_ratio,
+                int(rnd.lognormvariate(6, 0.5)),
+                request_time,
+                '|'.join(upstream))
+
+
+def parse_options(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic stats log lines, see stats.parser.py -h for format")
+    parser.add_argument('-o', '--output',
+                        help="file to write lines to, '-' for stdout")
+    add_options(parser)
+    return parser.parse_args(argv)
+
+
+def main():
+    options = parse_options()
+    if options.output == '-':
+        out = sys.stdout
+    else:
+        out = open(options.output, 'w')
+    try:
+        for line in LogGenerator(options).lines(options.lines):
+            out.write(line + '\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
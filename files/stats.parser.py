@@ -43,34 +43,63 @@
 ###
 
 
-from collections import (defaultdict, deque)
+from array import array
+from collections import defaultdict
+from contextlib import contextmanager
 from influxdb import InfluxDBClient
+from influxdb.line_protocol import make_lines
 from math import floor
-from pygtail import Pygtail
-from time import time
+from time import (sleep, time)
 import argparse
 try:
     import cPickle as pickle
 except:
     import pickle
+try:
+    import queue
+except:
+    import Queue as queue
+try:
+    import tracemalloc
+except ImportError:
+    # python 2
+    tracemalloc = None
+try:
+    import numpy
+except ImportError:
+    # --engine numpy is unavailable
+    numpy = None
+import cProfile
 import csv
 import datetime
+import glob
+import hashlib
+import heapq
 import gzip
 import inspect
 import itertools
 import json
 import math
+import mmap
+import multiprocessing
 import logging.handlers
 import logging.config
 import os.path
 import platform
+import pstats
+import random
 import re
-import shutil
+import signal
+import struct
+import string
 import sys
+import threading
 import traceback
+import zlib
 
 
 script_start_time = time()
+logger = logging.getLogger('stats.parser')
 
 # https://github.com/metabrainz/openresty-gateways/blob/master/files/nginx/nginx.conf#L23
 fieldnames = [
@@ -107,6 +136,26 @@ pos_upstream_response_time = 12
 pos_upstream_connect_time = 13
 pos_upstream_header_time = 14
 
+# fields a log format may lack, and the value they are parsed as then
+optional_fields = {
+    'protocol': '-',
+    'loctag': '-',
+    'bytes_sent': '0',
+    'request_length': '0',
+    'gzip_ratio': '-',
+    'request_time': '-',
+    'upstream_addr': '-',
+    'upstream_status': '-',
+    'upstream_response_time': '-',
+    'upstream_connect_time': '-',
+    'upstream_header_time': '-',
+}
+upstream_fields = ('upstream_addr', 'upstream_status', 'upstream_response_time',
+                   'upstream_connect_time', 'upstream_header_time')
+
+# log format version -> field names, lines are dispatched on their first
+# field, other formats are declared by log_formats in config
+log_formats = {'1': fieldnames}
 
 
 mbs_tags = {
@@ -127,7 +176,65 @@ mbs_tags = {
     'upstreams_response_time_mean': ('vhost', 'protocol', 'loctag', 'upstream'),
     'upstreams_connect_time_mean': ('vhost', 'protocol', 'loctag', 'upstream'),
     'upstreams_header_time_mean': ('vhost', 'protocol', 'loctag', 'upstream'),
+    'cardinality_folded_hits': ('dimension', ),
+}
+
+# --consolidated: measurements sharing one of these tag sets are written as
+# fields, named after them, of a single point per tag set and bucket
+consolidated_measurements = {
+    ('vhost', 'protocol', 'loctag'): 'requests',
+    ('vhost', 'protocol', 'loctag', 'upstream'): 'upstreams',
+}
+
+# durations also accumulated in latency sketches, a measurement per quantile
+# and one for the maximum are computed from each (ie. request_time_p99)
+sketched_tags = {
+    'request_time': ('vhost', 'protocol', 'loctag'),
+    'upstreams_response_time': ('vhost', 'protocol', 'loctag', 'upstream'),
+    'upstreams_connect_time': ('vhost', 'protocol', 'loctag', 'upstream'),
+    'upstreams_header_time': ('vhost', 'protocol', 'loctag', 'upstream'),
 }
+sketch_quantiles = (('p50', 0.5), ('p90', 0.9), ('p99', 0.99))
+
+for name, tagnames in sketched_tags.items():
+    for suffix, quantile in sketch_quantiles + (('max', None), ):
+        mbs_tags['%s_%s' % (name, suffix)] = tagnames
+
+# tag names -> number of measurements sharing them
+values_per_row = defaultdict(int)
+for tagnames in mbs_tags.values():
+    values_per_row[tagnames] += 1
+
+# typecode of integer accumulator arrays, python 2 has no long long arrays
+try:
+    array('q')
+    int_typecode = 'q'
+except ValueError:
+    int_typecode = 'l'
+
+# attribute and tag names of tables of Accumulator
+accumulator_tables = [
+    ('requests', ('vhost', 'protocol', 'loctag')),
+    ('status', ('vhost', 'protocol', 'loctag', 'status')),
+    ('upstreams', ('vhost', 'protocol', 'loctag', 'upstream')),
+    ('upstreams_status', ('vhost', 'protocol', 'loctag', 'upstream', 'status')),
+    ('folded', ('dimension', )),
+]
+
+# tag sets above, before extra tags of log formats are added to them
+request_tags = ('vhost', 'protocol', 'loctag')
+builtin_mbs_tags = dict(mbs_tags)
+builtin_consolidated_measurements = dict(consolidated_measurements)
+builtin_accumulator_tables = list(accumulator_tables)
+
+# extra tags and fields declared by log formats, name -> type, see
+# setup_log_formats(): tags are added, after request_tags, to tag sets of
+# all measurements of requests, fields are summed per request tag set
+extra_tags = dict()
+extra_fields = dict()
+# types of extra tags, and of extra fields with the typecode of their sums
+tag_types = ('str', 'int', 'float')
+field_typecodes = {'int': int_typecode, 'float': 'd'}
 
 def factory():
     return lambda x: x
@@ -143,6 +250,288 @@ def lineno():
     """Returns the current line number in our program."""
     return inspect.currentframe().f_back.f_lineno
 
+# upstream addresses and statuses are repeated a lot, this bounded cache
+# ensures all occurences share the same string object
+interned = dict()
+interned_max_size = 10000
+
+def intern_str(value):
+    try:
+        return interned[value]
+    except KeyError:
+        if len(interned) >= interned_max_size:
+            interned.clear()
+        interned[value] = value
+        return value
+
+# vhosts and upstreams beyond cardinality caps are folded into this value
+other_tag = '__other__'
+
+
+class LeastCounted(object):
+    """Values, and the oldest of the least counted of them, counts being
+    kept apart and only growing: a value has a single heap entry, moved
+    when it is found with an outdated count, so counting costs nothing
+    here"""
+    def __init__(self):
+        # value -> sequence of its heap entry
+        self.entries = dict()
+        # (count, sequence, value), entries of removed values included
+        self.heap = []
+        self.sequence = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, value):
+        return value in self.entries
+
+    def add(self, value, count):
+        self.sequence += 1
+        self.entries[value] = self.sequence
+        heapq.heappush(self.heap, (count, self.sequence, value))
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            entries = self.entries
+            self.heap = [entry for entry in self.heap
+                         if entries.get(entry[2]) == entry[1]]
+            heapq.heapify(self.heap)
+
+    def discard(self, value):
+        self.entries.pop(value, None)
+
+    def least(self, counts):
+        """Returns (value, count) of the oldest of the least counted values,
+        counts being value -> count"""
+        heap = self.heap
+        entries = self.entries
+        while True:
+            count, sequence, value = heap[0]
+            if entries.get(value) != sequence:
+                heapq.heappop(heap)
+            elif counts[value] != count:
+                self.sequence += 1
+                entries[value] = self.sequence
+                heapq.heapreplace(heap, (counts[value], self.sequence, value))
+            else:
+                return (value, count)
+
+
+class TopK(object):
+    """Space-saving heavy hitters, naming at most size values per bucket
+
+    Up to size * counted_per_named values are counted, a new value replaces
+    the oldest of the least counted ones and inherits its count, so counts
+    of the most counted values are accurate. The size most counted values
+    are the top ones, a value enters the top only once its count, less the
+    inherited part, beats the least counted top one (or 1, while there
+    are less than size top values, once values were replaced). fold()
+    counts a value and returns it if it is named in the bucket, other_tag
+    otherwise: a top value is named in a bucket while there are less than
+    size named values in it, and stays named for the whole bucket. Values
+    seen once, like random Host headers, never get their own series, and a
+    bucket has at most size named values, plus other_tag. Ties go to the
+    oldest values, so the same lines always give the same folds.
+    """
+    counted_per_named = 4
+
+    def __init__(self, size):
+        self.size = size
+        self.counts = dict()
+        # value -> count inherited from the value it replaced
+        self.errors = dict()
+        self.counted = LeastCounted()
+        self.replaced = False
+        self.top = LeastCounted()
+        # bucket -> values named in bucket
+        self.named = dict()
+
+    def fold(self, value, bucket, count=1):
+        counts = self.counts
+        known = counts.get(value)
+        if known is not None:
+            count += known
+        else:
+            least = 0
+            if len(counts) >= self.size * self.counted_per_named:
+                victim, least = self.counted.least(counts)
+                self.counted.discard(victim)
+                self.top.discard(victim)
+                del counts[victim]
+                del self.errors[victim]
+                count += least
+                self.replaced = True
+            self.counted.add(value, count)
+            self.errors[value] = least
+        counts[value] = count
+        top = self.top
+        if value not in top:
+            if len(top) < self.size:
+                if not self.replaced or count - self.errors[value] > 1:
+                    top.add(value, count)
+            else:
+                weakest, least = top.least(counts)
+                if count - self.errors[value] > least:
+                    top.discard(weakest)
+                    top.add(value, count)
+        try:
+            named = self.named[bucket]
+        except KeyError:
+            named = self.named[bucket] = set()
+        if value in named:
+            return value
+        if value in top and len(named) < self.size:
+            named.add(value)
+            return value
+        return other_tag
+
+    def forget(self, bucket):
+        """Forgets values named in buckets up to bucket, which won't get any
+        line anymore"""
+        for old in [b for b in self.named if b <= bucket]:
+            del self.named[old]
+
+
+class LatencySketch(object):
+    """Fixed size, mergeable, histogram of durations
+
+    Values are counted in bins whose bounds grow geometrically, so any
+    quantile is known within relative_accuracy. When there are more than
+    max_bins bins, lowest ones are collapsed, losing accuracy on lowest
+    quantiles only. Sketches are merged with +=.
+    """
+    __slots__ = ('bins', 'zeros', 'count', 'max')
+    relative_accuracy = 0.01
+    gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+    log_gamma = math.log(gamma)
+    max_bins = 512
+
+    def __init__(self):
+        self.bins = dict()
+        self.zeros = 0
+        self.count = 0
+        self.max = 0.0
+
+    def __getstate__(self):
+        return (self.bins, self.zeros, self.count, self.max)
+
+    def __setstate__(self, state):
+        self.bins, self.zeros, self.count, self.max = state
+
+    def add(self, value, count=1):
+        """Adds value, count times (lines of a sample stand for count
+        lines)"""
+        self.count += count
+        if value > self.max:
+            self.max = value
+        if value <= 0.0:
+            self.zeros += count
+            return
+        index = int(math.ceil(math.log(value) / self.log_gamma))
+        bins = self.bins
+        try:
+            bins[index] += count
+        except KeyError:
+            bins[index] = count
+            if len(bins) > self.max_bins:
+                self._collapse()
+
+    def __iadd__(self, other):
+        bins = self.bins
+        for index, count in other.bins.items():
+            bins[index] = bins.get(index, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        if other.max > self.max:
+            self.max = other.max
+        if len(bins) > self.max_bins:
+            self._collapse()
+        return self
+
+    def _collapse(self):
+        indexes = sorted(self.bins)
+        excess = len(indexes) - self.max_bins
+        target = indexes[excess]
+        for index in indexes[:excess]:
+            self.bins[target] += self.bins.pop(index)
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                # middle of the bin, in relative terms
+                value = 2 * self.gamma ** index / (self.gamma + 1)
+                return min(value, self.max)
+        return self.max
+
+
+# self metrics measurement
+internal_measurement = 'mbstats_internal'
+
+
+class RunStats(object):
+    """Self metrics: seconds spent per stage, and lines parsed per file,
+    since last reset()
+
+    Timers nest, time spent in a nested timer only counts for the nested
+    stage. Timers are for the main thread, sender threads use add().
+    """
+    stages = ('read', 'parse', 'aggregate', 'encode', 'send', 'status')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # time spent in nested timers, per running timer
+        self.nested = []
+        self.reset()
+
+    def reset(self):
+        self.start = time()
+        self.seconds = dict((stage, 0.0) for stage in self.stages)
+        # filename -> [parsed, skipped, late]
+        self.lines = dict()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.seconds[stage] += seconds
+
+    def count(self, filename, parsed, skipped, late=0):
+        counts = self.lines.setdefault(filename, [0, 0, 0])
+        counts[0] += parsed
+        counts[1] += skipped
+        counts[2] += late
+
+    @contextmanager
+    def timer(self, stage):
+        start = time()
+        self.nested.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time() - start
+            self.add(stage, elapsed - self.nested.pop())
+            if self.nested:
+                self.nested[-1] += elapsed
+
+    def timed(self, stage, iterable):
+        """Yields items of iterable, time spent getting them counts for
+        stage"""
+        iterator = iter(iterable)
+        while True:
+            with self.timer(stage):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+runstats = RunStats()
+
+
 #@profile
 def parse_upstreams(row):
     #servers were contacted ", "
@@ -180,80 +569,1448 @@ def parse_upstreams(row):
                     upstream_connect_time,
                     upstream_header_time
                    ):
-        k = item[0]
+        k = intern_str(item[0])
         r['servers'].append(k)
 # not using defauldict() here intentionally, because it requires lamba/function
 # and it breaks with pickle
         if k not in r['status']:
             r['status'][k] = dict()
-        if item[1] in r['status'][k]:
-            r['status'][k][item[1]] += 1
+        upstream_status = intern_str(item[1])
+        if upstream_status in r['status'][k]:
+            r['status'][k][upstream_status] += 1
         else:
-            r['status'][k][item[1]] = 1
+            r['status'][k][upstream_status] = 1
 
+        # converted first, so servers without a timing get no entry
         try:
-            r['response_time'][k] += float(item[2])
+            value = float(item[2])
         except ValueError:
             if item[2] not in ('-', ''):
                 raise
-            pass
+        else:
+            r['response_time'][k] += value
 
         try:
-            r['connect_time'][k] += float(item[3])
+            value = float(item[3])
         except ValueError:
             if item[3] not in ('-', ''):
                 raise
-            pass
+        else:
+            r['connect_time'][k] += value
 
         try:
-            r['header_time'][k] += float(item[4])
+            value = float(item[4])
         except ValueError:
             if item[4] not in ('-', ''):
                 raise
-            pass
+        else:
+            r['header_time'][k] += value
 
     return r
 
-class ParseEnd(Exception):
-    pass
+def split_lines(block):
+    """Returns lines of a raw block ending with an end of line, decoded at
+    once"""
+    if str is not bytes:
+        block = block.decode('utf-8', 'replace')
+    lines = block.split('\n')
+    # last element is empty since block ends with end of line
+    lines.pop()
+    return lines
+
+
+class Tailer(object):
+    """Reads complete lines appended to a log file since last position
+
+    Position is an (inode, offset) tuple, a change of inode or a file smaller
+    than offset means log was rotated, in which case the rest of the rotated
+    file is read first.
+    Data is read by large binary chunks (or through mmap() for big backlogs),
+    only complete lines are returned, by batches, and decoding is done once
+    per chunk.
+    """
+    def __init__(self, filename, position=None, chunk_size=1024*1024,
+                 mmap_threshold=64*1024*1024):
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.mmap_threshold = mmap_threshold
+        self.fh = None
+        self.path = None
+        self.inode = None
+        # offset of first byte not returned as part of a line
+        self.offset = 0
+        # bytes read after offset, not containing a complete line yet
+        self.buf = b''
+        # set while reading a file which isn't the live log anymore
+        self.rotated = None
+
+        st = os.stat(filename)
+        if position is None:
+            self._open(filename, st.st_ino, 0)
+            return
+        inode, offset = position
+        if inode == st.st_ino and offset <= st.st_size:
+            self._open(filename, inode, offset)
+            return
+        rotated = self._find_rotated(inode, copytruncate=(inode == st.st_ino))
+        if rotated:
+            logger.info("Log rotation detected, reading end of %s" % rotated)
+            self._open(rotated, inode, offset)
+            self.rotated = rotated
+        else:
+            logger.warning("Log rotation detected, but rotated file wasn't "
+                           "found, starting at beginning of %s" % filename)
+            self._open(filename, st.st_ino, 0)
+
+    def _find_rotated(self, inode, copytruncate=False):
+        candidates = ["%s.0" % self.filename, "%s.1" % self.filename]
+        # dateext rotation scheme, and TimedRotatingFileHandler
+        for pattern in ("%s-[0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9]",
+                        "%s.[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]"):
+            candidates += sorted(glob.glob(pattern % self.filename), reverse=True)
+        for candidate in candidates:
+            try:
+                st = os.stat(candidate)
+            except OSError:
+                continue
+            if st.st_ino == inode or copytruncate:
+                return candidate
+        return None
+
+    def _open(self, path, inode, offset):
+        if self.fh is not None:
+            self.fh.close()
+        self.fh = open(path, 'rb')
+        self.fh.seek(offset)
+        self.path = path
+        self.inode = inode
+        self.offset = offset
+        self.buf = b''
+
+    def position(self):
+        return (self.inode, self.offset)
+
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+    def follow_rotation(self):
+        """To be called at end of file, returns True if the log was rotated
+        since it was opened, next batches() will read the end of the old file
+        before switching to the new one"""
+        if self.rotated is not None:
+            return True
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            # moved away, and new file isn't created yet
+            return False
+        if st.st_ino != self.inode:
+            logger.info("Log rotation detected, %s was moved" % self.filename)
+            self.rotated = self.path
+            return True
+        if st.st_size < self.offset:
+            logger.info("Log rotation detected, %s was truncated" % self.filename)
+            self._open(self.filename, self.inode, 0)
+            return True
+        return False
+
+    def _last_line(self):
+        """Returns (start, end, raw line) of last complete line after
+        position, reading file backward from its end, or None"""
+        pos = os.fstat(self.fh.fileno()).st_size
+        data = b''
+        while pos > self.offset:
+            step = min(pos - self.offset, 64*1024)
+            pos -= step
+            self.fh.seek(pos)
+            data = self.fh.read(step) + data
+            last = data.rfind(b'\n')
+            if last < 0:
+                continue
+            start = data.rfind(b'\n', 0, last) + 1
+            if start or pos == self.offset:
+                return (pos + start, pos + last + 1, data[start:last])
+        return None
+
+    def skip_to(self, offset):
+        self._open(self.path, self.inode, offset)
+
+    def skip_to_last_line(self):
+        """Moves position to end of last complete line of file, and returns
+        this line (raw)"""
+        found = self._last_line()
+        if found is None:
+            self.skip_to(self.offset)
+            return None
+        self.skip_to(found[1])
+        return found[2]
+
+    def pending_bytes(self):
+        return os.fstat(self.fh.fileno()).st_size - self.offset
+
+    def bytes_behind(self):
+        """Returns bytes not read yet, including the live log if the end of
+        a rotated one is being read"""
+        behind = self.pending_bytes()
+        if self.rotated is not None:
+            try:
+                behind += os.stat(self.filename).st_size
+            except OSError:
+                pass
+        return behind
+
+    def split_pending(self, count):
+        """Returns up to count (start, end) ranges of complete lines, covering
+        file from position to end of its last complete line"""
+        found = self._last_line()
+        if found is None:
+            return []
+        end = found[1]
+        step = (end - self.offset) // count
+        bounds = [self.offset]
+        for i in range(1, count):
+            found = self._line_after(self.offset + i * step)
+            if found is not None and bounds[-1] < found[0] < end:
+                bounds.append(found[0])
+        bounds.append(end)
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def _line_after(self, pos):
+        """Returns (start, raw line) of first complete line starting at or
+        after pos, or None"""
+        if pos > 0:
+            self.fh.seek(pos - 1)
+            pos += len(self.fh.readline()) - 1
+        self.fh.seek(pos)
+        line = self.fh.readline()
+        if not line.endswith(b'\n'):
+            return None
+        return (pos, line)
+
+    def seek_line(self, key, target, lo=0):
+        """Binary search from offset lo to the first line for which
+        key(raw line) >= target, lines should be (mostly) sorted on key"""
+        hi = os.fstat(self.fh.fileno()).st_size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            found = self._line_after(mid)
+            if found is None or key(found[1]) >= target:
+                hi = mid
+            else:
+                lo = mid + 1
+        found = self._line_after(lo)
+        if found is None:
+            self.skip_to_last_line()
+        else:
+            self._open(self.path, self.inode, found[0])
+
+    def _chunks(self):
+        """Yields raw data read from file, until its end"""
+        fileno = self.fh.fileno()
+        start = self.fh.tell()
+        size = os.fstat(fileno).st_size
+        if size - start >= self.mmap_threshold:
+            mm = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+            try:
+                for pos in range(start, size, self.chunk_size):
+                    yield mm[pos:pos + self.chunk_size]
+            finally:
+                mm.close()
+            self.fh.seek(size)
+        while True:
+            data = self.fh.read(self.chunk_size)
+            if not data:
+                break
+            yield data
+
+    def batches(self, max_lines=0):
+        """Yields lists of lines (without end of line), stops at end of file,
+        or once max_lines were returned"""
+        remaining = max_lines
+        while True:
+            for data in self._chunks():
+                data = self.buf + data
+                end = data.rfind(b'\n') + 1
+                if not end:
+                    # no complete line yet
+                    self.buf = data
+                    continue
+                if remaining:
+                    count = data.count(b'\n', 0, end)
+                    if count >= remaining:
+                        end = 0
+                        for i in range(remaining):
+                            end = data.index(b'\n', end) + 1
+                        count = remaining
+                    remaining -= count
+                block = data[:end]
+                self.buf = data[end:]
+                self.offset += end
+                yield split_lines(block)
+                if max_lines and not remaining:
+                    # data after offset wasn't returned yet, read it again
+                    # next time (file position is still at the start of
+                    # the mmap range when reading through mmap)
+                    self.fh.seek(self.offset)
+                    self.buf = b''
+                    return
+            if self.rotated is None:
+                return
+            # end of rotated file, continue with the live one
+            if self.buf:
+                logger.warning("Ignoring incomplete last line of %s" % self.path)
+            self.rotated = None
+            self._open(self.filename, os.stat(self.filename).st_ino, 0)
+
+
+def open_archive(path):
+    """Opens a plain or gzip compressed file for binary reading"""
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+    if magic == b'\x1f\x8b':
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def archive_batches(path, offset=0, chunk_size=8*1024*1024):
+    """Yields (offset, lines) for complete lines of a plain or gzip
+    compressed file, starting at offset, offset is the one after lines, in
+    uncompressed bytes"""
+    fh = open_archive(path)
+    try:
+        # compressed files are decompressed up to offset
+        fh.seek(offset)
+        buf = b''
+        while True:
+            data = fh.read(chunk_size)
+            if not data:
+                break
+            data = buf + data
+            end = data.rfind(b'\n') + 1
+            if not end:
+                buf = data
+                continue
+            buf = data[end:]
+            offset += end
+            yield (offset, split_lines(data[:end]))
+        if buf:
+            logger.warning("Ignoring incomplete last line of %s" % path)
+    finally:
+        fh.close()
+
+
+def archive_first_msec(path):
+    for offset, lines in archive_batches(path, chunk_size=64*1024):
+        for line in lines:
+            try:
+                return float(line.split('|', pos_msec + 1)[pos_msec])
+            except (IndexError, ValueError):
+                pass
+    return 0.0
+
 
 class ParseSkip(Exception):
     pass
 
-def parsefile(tailer, status, options):
+def raw_line_msec(line):
+    return float(line.split(b'|', pos_msec + 1)[pos_msec])
+
+def line_hash(line):
+    """Returns a hash of line, the same across runs and python versions, so
+    sampling keeps the same lines"""
+    if str is not bytes:
+        line = line.encode('utf-8')
+    return zlib.crc32(line) & 0xffffffff
+
+# source of the parse loop of LineParser, specialized for each log format
+# version by line_parser(): $version is replaced by the version, $maxsplit by
+# the number of splits needed, $extra_tags by expressions of extra tags,
+# $field_columns and $field_values by statements accumulating extra fields,
+# other $names by the expression of a field
+line_parser_source = r'''
+def parse_lines(self, lines):
+    storage = self.storage
+    bucket_duration = self.bucket_duration
+    ignore_before = self.ignore_before
+    lookback_factor = self.lookback_factor
+    mbs = self.mbs
+    vhosts = self.vhosts
+    upstreams = self.upstreams
+    last_msec = self.last_msec
+    bucket = self.bucket
+    # lines stand for weight lines each, when sampled, see parse()
+    weight = self.sample_rate
+    # bucket of the most recent line, see process_passed()
+    max_bucket = int(math.ceil(last_msec / bucket_duration))
     parsed_lines = 0
     skipped_lines = 0
+    late_lines = 0
+    # bucket whose accumulator columns are bound to locals below
+    acc_bucket = None
+    # first line of another format, for parse()
+    other_line = None
+    for line in lines:
+        items = line.split('|', $maxsplit)
+        if items[0] != $version:
+            other_line = line
+            break
+        parsed_lines += 1
+        try:
+            msec = float($msec)
+            if msec <= ignore_before:
+                # skip unordered & old entries
+                raise ParseSkip
+            if msec > last_msec:
+                last_msec = msec
+            bucket = int(math.ceil(msec/bucket_duration))
+
+            status_code = int($status)
+            bytes_sent = int($bytes_sent) * weight
+            request_length = int($request_length) * weight
+
+            if bucket != acc_bucket:
+                # lines are folded into per-bucket accumulators as they
+                # come, so memory scales with tags cardinality; tables
+                # and columns are looked up only when bucket changes
+                try:
+                    acc = storage[bucket]
+                except KeyError:
+                    acc = storage[bucket] = Accumulator()
+                if acc.sample_rate < weight:
+                    acc.sample_rate = weight
+                acc_bucket = bucket
+                requests = acc.requests
+                r_ids = requests.ids
+                r_add = requests.add
+                columns = requests.columns
+                hits = columns['hits']
+                bytes_sent_sum = columns['bytes_sent']
+                request_length_sum = columns['_request_length_premean']
+                gzip_count = columns['gzip_count']
+                gzip_ratio_sum = columns['_gzip_ratio_premean']
+                request_time_sum = columns['_request_time_premean']
+                request_time_sketches = requests.sketches['request_time']
+                hits_with_upstream = columns['hits_with_upstream']
+                servers_contacted = columns['_upstreams_servers_contacted']
+                internal_redirects = columns['_upstreams_internal_redirects']
+                upstreams_servers = columns['upstreams_servers']
+                $field_columns
+                s_ids = acc.status.ids
+                s_add = acc.status.add
+                status_count = acc.status.columns['status']
+                u_ids = acc.upstreams.ids
+                u_add = acc.upstreams.add
+                columns = acc.upstreams.columns
+                upstreams_hits = columns['upstreams_hits']
+                response_time_sum = columns['_upstreams_response_time_premean']
+                connect_time_sum = columns['_upstreams_connect_time_premean']
+                header_time_sum = columns['_upstreams_header_time_premean']
+                sketches = acc.upstreams.sketches
+                response_time_sketches = sketches['upstreams_response_time']
+                connect_time_sketches = sketches['upstreams_connect_time']
+                header_time_sketches = sketches['upstreams_header_time']
+                us_ids = acc.upstreams_status.ids
+                us_add = acc.upstreams_status.add
+                upstreams_status_count = acc.upstreams_status.columns['upstreams_status']
+                folded = acc.folded
+
+            vhost = $vhost
+            if vhosts is not None:
+                vhost = vhosts.fold(vhost, bucket, weight)
+                if vhost == other_tag:
+                    folded.increment(('vhost', ), 'cardinality_folded_hits', weight)
+            tags = (vhost, $protocol, $loctag$extra_tags)
+            try:
+                row = r_ids[tags]
+            except KeyError:
+                row = r_add(tags)
+
+            hits[row] += weight
+            bytes_sent_sum[row] += bytes_sent
+            request_length_sum[row] += request_length
+            stags = tags + (status_code, )
+            try:
+                status_count[s_ids[stags]] += weight
+            except KeyError:
+                status_count[s_add(stags)] += weight
+
+            if $gzip_ratio != '-':
+                gzip_count[row] += weight
+                gzip_ratio_sum[row] += float($gzip_ratio) * weight
+            if $request_time != '-':
+                value = float($request_time)
+                request_time_sum[row] += value * weight
+                sketch = request_time_sketches[row]
+                if sketch is None:
+                    sketch = request_time_sketches[row] = LatencySketch()
+                sketch.add(value, weight)
+            $field_values
+
+            upstream_addr = $upstream_addr
+            if upstream_addr == '-':
+                pass
+            elif ' ' not in upstream_addr:
+                # fast path: one server contacted, no internal
+                # redirect (both separators contain a space)
+                upstream = intern_str(upstream_addr)
+                if upstreams is not None:
+                    upstream = upstreams.fold(upstream, bucket, weight)
+                    if upstream == other_tag:
+                        folded.increment(('upstream', ), 'cardinality_folded_hits', weight)
+                hits_with_upstream[row] += weight
+                servers_contacted[row] += weight
+                upstreams_servers[row] += weight
+                utags = tags + (upstream, )
+                try:
+                    urow = u_ids[utags]
+                except KeyError:
+                    urow = u_add(utags)
+                    response_time_sketches[urow] = LatencySketch()
+                    connect_time_sketches[urow] = LatencySketch()
+                    header_time_sketches[urow] = LatencySketch()
+                upstreams_hits[urow] += weight
+                # absent timings ('-' or empty) are left out of sketches
+                value = $upstream_response_time
+                if value != '-' and value:
+                    value = float(value)
+                    response_time_sum[urow] += value * weight
+                    response_time_sketches[urow].add(value, weight)
+                value = $upstream_connect_time
+                if value != '-' and value:
+                    value = float(value)
+                    connect_time_sum[urow] += value * weight
+                    connect_time_sketches[urow].add(value, weight)
+                value = $upstream_header_time.rstrip('\r\n')
+                if value != '-' and value:
+                    value = float(value)
+                    header_time_sum[urow] += value * weight
+                    header_time_sketches[urow].add(value, weight)
+                ustags = utags + (intern_str($upstream_status), )
+                try:
+                    upstreams_status_count[us_ids[ustags]] += weight
+                except KeyError:
+                    upstreams_status_count[us_add(ustags)] += weight
+            else:
+                # Note : last element may contain a trailing \r
+                ru = parse_upstreams({
+                'upstream_addr': $upstream_addr,
+                'upstream_status': $upstream_status,
+                'upstream_response_time': $upstream_response_time,
+                'upstream_connect_time': $upstream_connect_time,
+                'upstream_header_time': $upstream_header_time.rstrip('\r\n'),
+                })
+                hits_with_upstream[row] += weight
+                servers_contacted[row] += ru['servers_contacted'] * weight
+                internal_redirects[row] += ru['internal_redirects'] * weight
+                upstreams_servers[row] += len(ru['servers']) * weight
+                for server in ru['servers']:
+                    upstream = server
+                    if upstreams is not None:
+                        upstream = upstreams.fold(server, bucket, weight)
+                        if upstream == other_tag:
+                            folded.increment(('upstream', ), 'cardinality_folded_hits', weight)
+                    utags = tags + (upstream, )
+                    try:
+                        urow = u_ids[utags]
+                    except KeyError:
+                        urow = u_add(utags)
+                        response_time_sketches[urow] = LatencySketch()
+                        connect_time_sketches[urow] = LatencySketch()
+                        header_time_sketches[urow] = LatencySketch()
+                    upstreams_hits[urow] += weight
+                    # servers without a timing have no entry
+                    value = ru['response_time'].get(server)
+                    if value is not None:
+                        response_time_sum[urow] += value * weight
+                        response_time_sketches[urow].add(value, weight)
+                    value = ru['connect_time'].get(server)
+                    if value is not None:
+                        connect_time_sum[urow] += value * weight
+                        connect_time_sketches[urow].add(value, weight)
+                    value = ru['header_time'].get(server)
+                    if value is not None:
+                        header_time_sum[urow] += value * weight
+                        header_time_sketches[urow].add(value, weight)
+                    for upstream_status in ru['status'][server]:
+                        upstreams_status_count[acc.upstreams_status.row(utags + (upstream_status, ))] += weight
+
+            if mbs is None:
+                continue
+            if bucket <= max_bucket - lookback_factor:
+                # in grace buckets, corrected
+                late_lines += 1
+            if bucket <= max_bucket:
+                continue
+            max_bucket = bucket
+            self.process_passed(bucket)
+            ignore_before = self.ignore_before
+            acc_bucket = None
+        except ParseSkip:
+            skipped_lines += 1
+            pass
+        except Exception as e:
+            logger.error("%s: %r", e, line)
+            raise
+    self.parsed_lines += parsed_lines
+    self.skipped_lines += skipped_lines
+    self.late_lines += late_lines
+    self.ignore_before = ignore_before
+    self.last_msec = last_msec
+    self.bucket = bucket
+    return other_line
+'''
+
+
+def line_parser(version, names):
+    """Returns the parse loop of LineParser for lines of a log format
+    version, whose fields are names: lines are only split up to the last
+    field measured, fields the format lacks are replaced by their value in
+    optional_fields (extra tags by an empty value, left out of points), and
+    fields unknown to the parser are ignored"""
+    positions = dict((name, pos) for pos, name in enumerate(names))
+
+    def item(name):
+        # last field of a line may contain a trailing \r
+        if positions[name] == len(names) - 1:
+            return "items[%d].rstrip('\\r\\n')" % positions[name]
+        return 'items[%d]' % positions[name]
+
+    fields = dict()
+    for name in fieldnames:
+        if name in positions:
+            fields[name] = 'items[%d]' % positions[name]
+        else:
+            fields[name] = repr(optional_fields[name])
+    fields['version'] = repr(version)
+    fields['maxsplit'] = max(positions[name] for name in positions
+                             if name in fieldnames or name in extra_tags
+                             or name in extra_fields) + 1
+    tags = []
+    for name in sorted(extra_tags):
+        if name not in positions:
+            tags.append("''")
+        elif extra_tags[name] == 'str':
+            tags.append('intern_str(%s)' % item(name))
+        else:
+            # absent values are kept as '-'
+            tags.append("(%s if %s == '-' else %s(%s))"
+                        % (item(name), item(name), extra_tags[name], item(name)))
+    fields['extra_tags'] = ''.join(', ' + tag for tag in tags)
+    columns = []
+    values = []
+    for i, name in enumerate(sorted(extra_fields)):
+        if name not in positions:
+            continue
+        columns.append('field_sum_%d = columns[%r]' % (i, name + '_sum'))
+        columns.append('field_count_%d = columns[%r]' % (i, '_%s_count' % name))
+        values.extend([
+            'value = %s' % item(name),
+            "if value != '-' and value:",
+            '    field_sum_%d[row] += %s(value) * weight' % (i, extra_fields[name]),
+            '    field_count_%d[row] += weight' % i,
+        ])
+    fields['field_columns'] = '\n                '.join(columns)
+    fields['field_values'] = '\n            '.join(values)
+    source = string.Template(line_parser_source).substitute(fields)
+    namespace = dict()
+    exec(compile(source, '<log format %s>' % version, 'exec'), globals(),
+         namespace)
+    return namespace['parse_lines']
+
+
+def extra_field(version, entry):
+    """Returns name, influx ('tag' or 'field') and type of an extra field
+    declared by log format version, raises ValueError if it is invalid"""
+    if set(entry) - set(['name', 'influx', 'type']):
+        raise ValueError("log format %s: extra fields have name, influx and type only"
+                         % version)
+    name = entry.get('name')
+    influx = entry.get('influx')
+    if not isinstance(name, (str, type(u''))) or not re.match(r'[a-z][a-z0-9_]*$', name):
+        raise ValueError("log format %s: invalid extra field name %r"
+                         % (version, name))
+    reserved = set(fieldnames) | set(['dc', 'host', 'name'])
+    for tagnames in builtin_mbs_tags.values():
+        reserved.update(tagnames)
+    if name in reserved:
+        raise ValueError("log format %s: %s is already a field or tag"
+                         % (version, name))
+    if influx == 'tag':
+        type_ = entry.get('type', 'str')
+        if type_ not in tag_types:
+            raise ValueError("log format %s: tag %s: type must be one of %s"
+                             % (version, name, ', '.join(tag_types)))
+    elif influx == 'field':
+        type_ = entry.get('type', 'float')
+        if type_ not in field_typecodes:
+            raise ValueError("log format %s: field %s: type must be one of %s"
+                             % (version, name, ', '.join(sorted(field_typecodes))))
+        if name + '_sum' in builtin_mbs_tags or name + '_mean' in builtin_mbs_tags:
+            raise ValueError("log format %s: field %s: measurements exist already"
+                             % (version, name))
+    else:
+        raise ValueError("log format %s: %s: influx must be tag or field"
+                         % (version, name))
+    return str(name), influx, str(type_)
+
+
+def setup_extra_tags():
+    """Adds extra tags of log formats to tag sets of measurements of
+    requests, after request_tags, and adds NAME_sum and NAME_mean
+    measurements of extra fields"""
+    added = tuple(sorted(extra_tags))
+
+    def extended(tagnames):
+        if tagnames[:len(request_tags)] != request_tags:
+            return tagnames
+        return request_tags + added + tagnames[len(request_tags):]
+
+    mbs_tags.clear()
+    for name, tagnames in builtin_mbs_tags.items():
+        mbs_tags[name] = extended(tagnames)
+    for name in extra_fields:
+        mbs_tags[name + '_sum'] = mbs_tags[name + '_mean'] = extended(request_tags)
+    consolidated_measurements.clear()
+    for tagnames, name in builtin_consolidated_measurements.items():
+        consolidated_measurements[extended(tagnames)] = name
+    accumulator_tables[:] = [(name, extended(tagnames))
+                             for name, tagnames in builtin_accumulator_tables]
+    values_per_row.clear()
+    for tagnames in mbs_tags.values():
+        values_per_row[tagnames] += 1
+
+
+def setup_log_formats(formats):
+    """Adds log formats (version -> fields) to built-in ones, and builds
+    their parse loops, raises ValueError if one is invalid
+
+    A field is a field name, or the declaration of an extra field, like
+    {"name": "ssl_protocol", "influx": "tag", "type": "str"}, see
+    extra_tags and extra_fields. An extra field is declared the same way by
+    all formats having it.
+    """
+    tags = dict(extra_tags)
+    fields = dict(extra_fields)
+    formats = dict(formats)
+    for version, entries in sorted(formats.items()):
+        if not isinstance(entries, list):
+            raise ValueError("log format %s: expected a list of fields"
+                             % version)
+        if '|' in version or not version:
+            raise ValueError("log format %r: invalid version" % version)
+        names = []
+        for entry in entries:
+            if isinstance(entry, dict):
+                name, influx, type_ = extra_field(version, entry)
+                declared = tags if influx == 'tag' else fields
+                if (name in tags or name in fields) and declared.get(name) != type_:
+                    raise ValueError("log format %s: %s is declared differently by another format"
+                                     % (version, name))
+                declared[name] = type_
+                entry = name
+            names.append(entry)
+        if names[:2] != ['version', 'msec']:
+            raise ValueError("log format %s: first fields must be version and msec"
+                             % version)
+        if len(set(names)) != len(names):
+            raise ValueError("log format %s: duplicate fields" % version)
+        missing = [name for name in fieldnames
+                   if name not in names and name not in optional_fields]
+        if missing:
+            raise ValueError("log format %s: missing fields %s"
+                             % (version, ', '.join(missing)))
+        if 0 < len(set(upstream_fields) & set(names)) < len(upstream_fields):
+            raise ValueError("log format %s: upstream fields go together: %s"
+                             % (version, ', '.join(upstream_fields)))
+        formats[version] = names
+    extra_tags.update(tags)
+    extra_fields.update(fields)
+    setup_extra_tags()
+    log_formats.update(formats)
+    for version, names in log_formats.items():
+        line_parsers[version] = line_parser(version, names)
+
+
+# log format version -> parse loop, see line_parser()
+line_parsers = dict()
+setup_log_formats(dict())
+
+
+class LineParser(object):
+    """Folds lines into per-bucket accumulators of storage (Accumulator)
+
+    Lines logged before ignore_before are skipped. If mbs is set, buckets
+    are processed as soon as the watermark passes them, once a line from
+    lookback_factor buckets later is parsed, otherwise buckets are only
+    accumulated. Lines of buckets the watermark passed are skipped as too
+    late then, unless they are within the grace period of corrections
+    (Corrections), whose buckets are processed again: these lines are
+    counted in late_lines. If vhosts or
+    upstreams are set (TopK), values they fold are replaced by other_tag.
+    Processed buckets are also added to rollups (Rollup objects), if any.
+    With the numpy engine, big blocks of lines are parsed by
+    parse_columns(). If sample_rate is more than 1, only 1 line in
+    sample_rate is parsed, chosen by a hash of the line, and its values are
+    counted sample_rate times.
+    """
+    # smaller blocks are parsed line by line, even with the numpy engine
+    columns_min_lines = 1000
+
+    def __init__(self, storage, bucket_duration, ignore_before=0,
+                 last_msec=0, lookback_factor=0, mbs=None, status=None,
+                 quiet=2, vhosts=None, upstreams=None, rollups=None,
+                 engine='python', corrections=None, sample_rate=1):
+        self.storage = storage
+        self.sample_rate = sample_rate
+        self.engine = engine
+        self.rollups = rollups
+        self.corrections = corrections
+        self.vhosts = vhosts
+        self.upstreams = upstreams
+        self.bucket_duration = bucket_duration
+        self.ignore_before = ignore_before
+        self.lookback_factor = lookback_factor
+        self.mbs = mbs
+        self.status = status
+        self.quiet = quiet
+        self.parsed_lines = 0
+        self.skipped_lines = 0
+        # lines accepted in buckets the watermark passed, see Corrections
+        self.late_lines = 0
+        self.last_msec = last_msec
+        # bucket of last line parsed
+        self.bucket = 0
+
+    def parse(self, lines):
+        if self.sample_rate > 1:
+            lines = self.sample(lines)
+        if (self.engine == 'numpy' and isinstance(lines, list)
+                and len(lines) >= self.columns_min_lines
+                and self.parse_columns(lines)):
+            return
+        lines = iter(lines)
+        line = next(lines, None)
+        while line is not None:
+            version = line.split('|', 1)[0]
+            try:
+                line_parser = line_parsers[version]
+            except KeyError:
+                logger.error("Unknown log format version %r: %r", version, line)
+                raise ValueError("Unknown log format version %r" % version)
+            # parses lines up to one of another format
+            line = line_parser(self, itertools.chain((line, ), lines))
+
+    def sample(self, lines):
+        """Returns lines whose hash is a multiple of sample_rate, others
+        count as parsed"""
+        sample_rate = self.sample_rate
+        sampled = [line for line in lines if not line_hash(line) % sample_rate]
+        self.parsed_lines += len(lines) - len(sampled)
+        return sampled
+
+    def process_passed(self, max_bucket=None):
+        """Processes buckets of storage the watermark passed, in order: the
+        ones lookback_factor buckets older than max_bucket, the bucket of
+        the most recent line by default, lines of older buckets than the
+        grace period of corrections are skipped from now on"""
+        if max_bucket is None:
+            max_bucket = int(math.ceil(self.last_msec / self.bucket_duration))
+        grace = 0
+        if self.corrections is not None:
+            grace = self.corrections.grace
+        late = (max_bucket - self.lookback_factor - grace) * self.bucket_duration
+        if late > self.ignore_before:
+            self.ignore_before = late
+            # buckets no line can go to anymore
+            done = int(self.ignore_before // self.bucket_duration)
+            for topk in (self.vhosts, self.upstreams):
+                if topk is not None:
+                    topk.forget(done)
+        storage = self.storage
+        for bucket in sorted(storage):
+            if bucket > max_bucket - self.lookback_factor:
+                break
+            if self.quiet < 2:
+                logger.info("Processing bucket: %s %d" %
+                            (bucket2time(bucket, self.status),
+                             bucket_hits(storage[bucket])))
+            with runstats.timer('aggregate'):
+                process_bucket(bucket, storage, self.status, self.mbs,
+                               self.rollups, self.corrections)
+
+    def parse_columns(self, lines):
+        """Parses lines with NumPy, column by column, returns False without
+        changing anything if they can't be (malformed lines, lines of
+        several log formats, extra tags or fields declared by log formats,
+        or buckets processed as soon as one of their lines is parsed), so
+        they are parsed line by line instead, which reports errors
+
+        Results are identical to parse(): lines are split in runs of a same
+        bucket, so buckets are processed after the same lines, float sums are
+        added in line order (numpy.add.at is unbuffered), and TopK folds are
+        done in line order. Upstreams with several servers or internal
+        redirects are parsed by parse_upstreams().
+        """
+        np = numpy
+        mbs = self.mbs
+        if mbs is not None and self.lookback_factor < 1:
+            return False
+        if extra_tags or extra_fields:
+            return False
+        # blocks of a single log format, having all fields measured
+        version = lines[0].split('|', 1)[0]
+        names = log_formats.get(version)
+        if names is None or not set(fieldnames).issubset(names):
+            return False
+        positions = dict((name, pos) for pos, name in enumerate(names)
+                         if name in fieldnames)
+        separators = lines[0].count('|')
+        if separators < max(positions.values()):
+            return False
+        counts = set(map(str.count, lines, itertools.repeat('|', len(lines))))
+        if counts != set([separators]):
+            return False
+        # all lines have the same number of fields, split at once
+        values = '|'.join(lines).split('|')
+        width = separators + 1
+        fields = dict()
+        for name, pos in positions.items():
+            fields[name] = values[pos::width]
+        del values
+        if set(fields['version']) != set([version]):
+            return False
+        try:
+            msec = np.fromiter(map(float, fields['msec']), np.float64, len(lines))
+        except ValueError:
+            return False
+        if not (np.abs(msec) < 2.0 ** 53).all():
+            return False
+        buckets = np.ceil(msec / self.bucket_duration).astype(np.int64)
+        late_lines = 0
+        if mbs is None:
+            kept = ~(msec <= self.ignore_before)
+        else:
+            # lines are skipped as too late once a line of a later bucket
+            # moved the watermark, as process_passed() does line by line
+            first_bucket = int(math.ceil(self.last_msec / self.bucket_duration))
+            before = np.maximum.accumulate(np.concatenate(([first_bucket],
+                                                           buckets[:-1])))
+            grace = 0
+            if self.corrections is not None:
+                grace = self.corrections.grace
+            late = (before - self.lookback_factor - grace) * self.bucket_duration
+            kept = ~(msec <= np.where(before > first_bucket,
+                                      np.maximum(late, self.ignore_before),
+                                      self.ignore_before))
+            # a skipped line doesn't move the watermark
+            if (buckets[~kept] > before[~kept]).any():
+                return False
+            late_lines = int((buckets[kept] <= before[kept]
+                              - self.lookback_factor).sum())
+        kept = np.flatnonzero(kept)
+        if len(kept) < len(lines):
+            msec = msec[kept]
+            buckets = buckets[kept]
+            keep = kept.tolist()
+            fields = dict((name, [column[i] for i in keep])
+                          for name, column in fields.items())
+        count = len(kept)
+        if not count:
+            self.parsed_lines += len(lines)
+            self.skipped_lines += len(lines)
+            return True
+
+        def present(values):
+            """Returns a numpy mask of values which aren't '-'"""
+            return np.fromiter(map('-'.__ne__, values), bool, len(values))
+
+        def floats(values, absent=('-', )):
+            """Returns a numpy array of values as floats, absent ones are 0.0"""
+            zeros = dict.fromkeys(absent, '0')
+            return np.fromiter(map(float, map(zeros.get, values, values)),
+                               np.float64, len(values))
+
+        # all values are converted before any state is changed
+        try:
+            c = {'weight': self.sample_rate}
+            for name in ('status', 'bytes_sent', 'request_length'):
+                c[name] = np.fromiter(map(int, fields[name]), np.int64, count)
+            for name in ('gzip_ratio', 'request_time'):
+                c['has_' + name] = present(fields[name])
+                c[name] = floats(fields[name])
+            if not np.isfinite(c['request_time']).all():
+                return False
+
+            # upstreams, an entry per server contacted: lines with a single
+            # one are handled by columns, others by parse_upstreams()
+            addrs = fields['upstream_addr']
+            c['has_upstream'] = present(addrs)
+            single = [i for i, addr in enumerate(addrs)
+                      if addr != '-' and ' ' not in addr]
+            c['contacted'] = np.zeros(count, dtype=np.int64)
+            c['contacted'][single] = 1
+            c['redirects'] = np.zeros(count, dtype=np.int64)
+            c['servers'] = c['contacted'].copy()
+            e_line = list(single)
+            e_upstream = [intern_str(addrs[i]) for i in single]
+            e_status = [(intern_str(fields['upstream_status'][i]), ) for i in single]
+            e_times = []
+            # absent timings are 0.0 in e_times, and False in e_timed
+            e_timed = []
+            for name in ('upstream_response_time', 'upstream_connect_time',
+                         'upstream_header_time'):
+                values = [fields[name][i] for i in single]
+                if name == 'upstream_header_time':
+                    values = [v.rstrip('\r\n') for v in values]
+                e_times.append(floats(values, ('-', '')).tolist())
+                e_timed.append([value not in ('-', '') for value in values])
+            redirected = [i for i, addr in enumerate(addrs) if ' ' in addr]
+            for i in redirected:
+                ru = parse_upstreams({
+                    'upstream_addr': addrs[i],
+                    'upstream_status': fields['upstream_status'][i],
+                    'upstream_response_time': fields['upstream_response_time'][i],
+                    'upstream_connect_time': fields['upstream_connect_time'][i],
+                    'upstream_header_time': fields['upstream_header_time'][i].rstrip('\r\n'),
+                })
+                c['contacted'][i] = ru['servers_contacted']
+                c['redirects'][i] = ru['internal_redirects']
+                c['servers'][i] = len(ru['servers'])
+                for server in ru['servers']:
+                    e_line.append(i)
+                    e_upstream.append(server)
+                    e_status.append(tuple(ru['status'][server]))
+                    for times, timed, name in zip(e_times, e_timed,
+                                                  ('response_time',
+                                                   'connect_time',
+                                                   'header_time')):
+                        value = ru[name].get(server)
+                        times.append(value or 0.0)
+                        timed.append(value is not None)
+            e = {'line': np.array(e_line, dtype=np.intp)}
+            if redirected:
+                # entries in line order, servers of a line in their order
+                order = np.argsort(e['line'], kind='stable')
+                e['line'] = e['line'][order]
+                order = order.tolist()
+                e_upstream = [e_upstream[i] for i in order]
+                e_status = [e_status[i] for i in order]
+                e_times = [[times[i] for i in order] for times in e_times]
+                e_timed = [[timed[i] for i in order] for timed in e_timed]
+            for times, timed, name in zip(e_times, e_timed,
+                                          ('response_time', 'connect_time',
+                                           'header_time')):
+                e[name] = np.array(times, dtype=np.float64)
+                e['has_' + name] = np.array(timed, dtype=bool)
+                if not np.isfinite(e[name]).all():
+                    return False
+        except (ValueError, OverflowError):
+            return False
+        # statuses of entries, several for a server with internal redirects
+        e['status_entry'] = np.array([entry for entry, statuses in enumerate(e_status)
+                                      for status in statuses], dtype=np.intp)
+        e['status_code'], status_names = value_codes([status for statuses in e_status
+                                                      for status in statuses])
+
+        # folded in line order, in the bucket of their line
+        vhost = fields['vhost']
+        weight = self.sample_rate
+        if self.vhosts is not None:
+            vhost = list(map(self.vhosts.fold, vhost, buckets.tolist(),
+                             itertools.repeat(weight, count)))
+        if self.upstreams is not None:
+            e_upstream = list(map(self.upstreams.fold, e_upstream,
+                                  buckets[e['line']].tolist(),
+                                  itertools.repeat(weight, len(e_upstream))))
+        c['tags'], code_tags = value_codes(list(zip(vhost, fields['protocol'],
+                                                    fields['loctag'])))
+        e['upstream'], upstream_names = value_codes(e_upstream)
+        # values folded by TopK
+        c['vhost_folded'] = np.zeros(count, dtype=bool)
+        if self.vhosts is not None:
+            folded = np.array([tags[0] == other_tag for tags in code_tags], dtype=bool)
+            c['vhost_folded'] = folded[c['tags']]
+        e['folded'] = np.zeros(len(e_upstream), dtype=bool)
+        if self.upstreams is not None and e_upstream:
+            folded = np.array([u == other_tag for u in upstream_names], dtype=bool)
+            e['folded'] = folded[e['upstream']]
+
+        # accumulators receiving runs of lines of a same bucket, as parse()
+        # would fill them: a bucket processed in the middle of lines gets a
+        # new accumulator for next ones
+        storage = self.storage
+        lookback_factor = self.lookback_factor
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+        lengths = np.diff(np.concatenate((starts, [count])))
+        accs = []
+        current = dict()
+        live = set(storage)
+        # ('install', bucket, acc) and ('process', max_bucket), in order
+        ops = []
+        max_bucket = int(math.ceil(self.last_msec / self.bucket_duration))
+        runs = []
+        for bucket in buckets[starts].tolist():
+            if bucket not in current:
+                if bucket in live:
+                    acc = storage[bucket]
+                else:
+                    acc = Accumulator()
+                    live.add(bucket)
+                    ops.append(('install', bucket, acc))
+                current[bucket] = len(accs)
+                accs.append(acc)
+            runs.append(current[bucket])
+            if mbs is None or bucket <= max_bucket:
+                continue
+            max_bucket = bucket
+            ops.append(('process', bucket, None))
+            for ready_to_process in sorted(live):
+                if ready_to_process > bucket - lookback_factor:
+                    break
+                live.discard(ready_to_process)
+                current.pop(ready_to_process, None)
+        line_acc = np.repeat(np.array(runs, dtype=np.intp), lengths)
+        entry_acc = line_acc[e['line']]
+        for index, acc in enumerate(accs):
+            if acc.sample_rate < self.sample_rate:
+                acc.sample_rate = self.sample_rate
+            add_columns(acc, c, np.flatnonzero(line_acc == index), e,
+                        np.flatnonzero(entry_acc == index),
+                        (code_tags, upstream_names, status_names))
+
+        for op, bucket, acc in ops:
+            if op == 'install':
+                storage[bucket] = acc
+            else:
+                self.process_passed(bucket)
+
+        self.parsed_lines += len(lines)
+        self.skipped_lines += len(lines) - count
+        self.late_lines += late_lines
+        last_msec = float(msec.max())
+        if last_msec > self.last_msec:
+            self.last_msec = last_msec
+        self.bucket = int(buckets[-1])
+        return True
+
+
+def value_codes(values):
+    """Returns (numpy array of codes of values, distinct values), codes are
+    given in order of appearance"""
+    distinct = list(dict.fromkeys(values))
+    codes = dict(zip(distinct, range(len(distinct))))
+    return (numpy.fromiter(map(codes.__getitem__, values), numpy.intp,
+                           len(values)),
+            distinct)
+
+
+def table_rows(table, keys, key_tags):
+    """Returns row ids of table for keys (numpy array of integer codes),
+    key_tags returns tags of a key, rows are added as needed"""
+    unique, inverse = numpy.unique(keys, return_inverse=True)
+    tags = [key_tags(key) for key in unique.tolist()]
+    ids = table.ids
+    missing = [t for t in tags if t not in ids]
+    if missing:
+        table.extend(missing)
+    rows = numpy.fromiter(map(ids.__getitem__, tags), numpy.intp, len(tags))
+    return rows[inverse.reshape(-1)]
+
+
+def add_at(column, rows, values):
+    """Adds values to column (array) at rows, one after the other"""
+    numpy.add.at(numpy.frombuffer(column, dtype=column.typecode), rows, values)
+
+
+def add_sketch_values(sketches, rows, values, weight=1):
+    """Adds values to sketches (list of LatencySketch or None) at rows, each
+    one weight times, with the same result as adding them one by one"""
+    np = numpy
+    if not len(rows):
+        return
+    log_gamma = LatencySketch.log_gamma
+    positive = values > 0.0
+    scaled = np.log(np.where(positive, values, 1.0)) / log_gamma
+    indexes = np.ceil(scaled)
+    # numpy.log may be an ulp away from math.log, used by LatencySketch.add(),
+    # which only matters close to an integer
+    close = np.flatnonzero(positive & (np.abs(scaled - np.rint(scaled)) < 1e-9))
+    if len(close):
+        indexes[close] = [math.ceil(math.log(value) / log_gamma)
+                          for value in values[close].tolist()]
+    indexes = indexes.astype(np.int64)
+    # zeros are counted in a bin below all others
+    low = indexes[positive].min() - 1 if positive.any() else 0
+    indexes[~positive] = low
+    span = indexes.max() - low + 1
+    keys, counts = np.unique(rows * span + (indexes - low), return_counts=True)
+    counts *= weight
+    key_rows = keys // span
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(key_rows)) + 1))
+    ends = np.concatenate((starts[1:], [len(keys)]))
+    totals = np.add.reduceat(counts, starts)
+    maxima = np.zeros(len(sketches))
+    np.maximum.at(maxima, rows, values)
+    indexes = (keys % span + low).tolist()
+    counts = counts.tolist()
+    for row, start, end, total in zip(key_rows[starts].tolist(), starts.tolist(),
+                                      ends.tolist(), totals.tolist()):
+        sketch = sketches[row]
+        if sketch is None:
+            sketch = sketches[row] = LatencySketch()
+        bins = sketch.bins
+        zeros = 0
+        if indexes[start] == low:
+            zeros = counts[start]
+            start += 1
+        if (len(bins) + end - start > sketch.max_bins
+                and len(set(bins).union(indexes[start:end])) > sketch.max_bins):
+            # bins are collapsed along the way, which depends on order
+            for value in values[rows == row].tolist():
+                sketch.add(value, weight)
+            continue
+        for index, count in zip(indexes[start:end], counts[start:end]):
+            bins[index] = bins.get(index, 0) + count
+        sketch.zeros += zeros
+        sketch.count += total
+        value = float(maxima[row])
+        if value > sketch.max:
+            sketch.max = value
+
+
+def add_columns(acc, c, lines, e, entries, names):
+    """Adds values of lines (indexes in columns c) and of upstream entries
+    (indexes in e) to accumulator, see LineParser.parse_columns(), names are
+    lists of tags, upstreams and upstream statuses, indexed by their codes,
+    values of sampled lines are counted c['weight'] times"""
+    code_tags, upstream_names, status_names = names
+    weight = c['weight']
+
+    def weighted(values):
+        """Returns values (numpy array) scaled by weight"""
+        return values * weight if weight != 1 else values
+
+    tags = c['tags'][lines]
+    table = acc.requests
+    rows = table_rows(table, tags, lambda code: code_tags[code])
+    columns = table.columns
+    add_at(columns['hits'], rows, weight)
+    add_at(columns['bytes_sent'], rows, weighted(c['bytes_sent'][lines]))
+    add_at(columns['_request_length_premean'], rows, weighted(c['request_length'][lines]))
+    mask = c['has_gzip_ratio'][lines]
+    add_at(columns['gzip_count'], rows[mask], weight)
+    add_at(columns['_gzip_ratio_premean'], rows[mask], weighted(c['gzip_ratio'][lines][mask]))
+    mask = c['has_request_time'][lines]
+    values = c['request_time'][lines][mask]
+    add_at(columns['_request_time_premean'], rows[mask], weighted(values))
+    add_sketch_values(table.sketches['request_time'], rows[mask], values, weight)
+    mask = c['has_upstream'][lines]
+    add_at(columns['hits_with_upstream'], rows[mask], weight)
+    add_at(columns['_upstreams_servers_contacted'], rows[mask], weighted(c['contacted'][lines][mask]))
+    add_at(columns['_upstreams_internal_redirects'], rows[mask], weighted(c['redirects'][lines][mask]))
+    add_at(columns['upstreams_servers'], rows[mask], weighted(c['servers'][lines][mask]))
+
+    # keys of several codes are combined in a single integer, as
+    # numpy.unique() is much slower on rows
+    table = acc.status
+    statuses, codes = numpy.unique(c['status'][lines], return_inverse=True)
+    statuses = statuses.tolist()
+    size = len(statuses)
+    rows = table_rows(table, tags * size + codes.reshape(-1),
+                      lambda key: code_tags[key // size] + (statuses[key % size], ))
+    add_at(table.columns['status'], rows, weight)
+
+    folded = int(c['vhost_folded'][lines].sum()) * weight
+    if folded:
+        acc.folded.columns['cardinality_folded_hits'][acc.folded.row(('vhost', ))] += folded
+    if not len(entries):
+        return
+
+    table = acc.upstreams
+    size = len(upstream_names)
+    keys = c['tags'][e['line'][entries]] * size + e['upstream'][entries]
+    rows = table_rows(table, keys,
+                      lambda key: code_tags[key // size] + (upstream_names[key % size], ))
+    columns = table.columns
+    add_at(columns['upstreams_hits'], rows, weight)
+    for name in ('response_time', 'connect_time', 'header_time'):
+        sketches = table.sketches['upstreams_' + name]
+        # rows get sketches even without timings, as with parse()
+        for row in numpy.unique(rows).tolist():
+            if sketches[row] is None:
+                sketches[row] = LatencySketch()
+        mask = e['has_' + name][entries]
+        values = e[name][entries][mask]
+        add_at(columns['_upstreams_%s_premean' % name], rows[mask], weighted(values))
+        add_sketch_values(sketches, rows[mask], values, weight)
+
+    entry_rows = numpy.zeros(len(e['line']), dtype=numpy.intp)
+    entry_rows[entries] = rows
+    selected = numpy.zeros(len(e['line']), dtype=bool)
+    selected[entries] = True
+    mask = selected[e['status_entry']]
+    size = len(status_names)
+    keys = entry_rows[e['status_entry'][mask]] * size + e['status_code'][mask]
+    utags = table.tags
+    table = acc.upstreams_status
+    rows = table_rows(table, keys,
+                      lambda key: utags[key // size] + (status_names[key % size], ))
+    add_at(table.columns['upstreams_status'], rows, weight)
+
+    folded = int(e['folded'][entries].sum()) * weight
+    if folded:
+        acc.folded.columns['cardinality_folded_hits'][acc.folded.row(('upstream', ))] += folded
+
+
+def catchup_worker_init(formats):
+    """Sets up a catch-up worker, log formats of config are passed, as
+    workers don't inherit them unless forked"""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    setup_log_formats(formats)
+
+
+def parse_range(args):
+    """Catch-up worker: parses lines between start and end offsets of file,
+    returns per-bucket accumulators and counters, vhosts and upstreams are
+    not folded, see catchup"""
+    (path, start, end, ignore_before, bucket_duration, chunk_size, engine,
+     sample_rate) = args
+    parser = LineParser(dict(), bucket_duration, ignore_before, engine=engine,
+                        sample_rate=sample_rate)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        pos = start
+        data = b''
+        while pos < end:
+            chunk = f.read(min(chunk_size, end - pos))
+            if not chunk:
+                break
+            pos += len(chunk)
+            data += chunk
+            last = data.rfind(b'\n') + 1
+            if last:
+                parser.parse(split_lines(data[:last]))
+                data = data[last:]
+    return (parser.storage, parser.parsed_lines, parser.skipped_lines,
+            parser.last_msec, parser.bucket)
+
+
+def catchup(tailer, parser, options):
+    """Parses all pending lines of tailer with a pool of processes, each
+    working on a range of lines, partial accumulators are folded by parser
+    TopKs, in order of lines, and merged into parser storage, then buckets
+    old enough are processed, in order"""
+    workers = options.catchup_workers or multiprocessing.cpu_count()
+    if workers < 2:
+        return
+    ranges = tailer.split_pending(workers * 4)
+    if not ranges:
+        return
+    logger.info("Catch-up: parsing %d bytes of %s in %d chunks, %d workers" %
+                (ranges[-1][1] - ranges[0][0], tailer.path, len(ranges),
+                 workers))
+    pool = multiprocessing.Pool(workers, catchup_worker_init,
+                                (options.log_formats, ))
+    try:
+        results = pool.map(parse_range,
+                           [(tailer.path, start, end, parser.ignore_before,
+                             parser.bucket_duration, tailer.chunk_size,
+                             parser.engine, parser.sample_rate)
+                            for start, end in ranges], 1)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    storage = parser.storage
+    # lines of buckets the watermark passed already, in grace buckets
+    passed = (int(math.ceil(parser.last_msec / parser.bucket_duration))
+              - parser.lookback_factor)
+    for partial, parsed_lines, skipped_lines, last_msec, bucket in results:
+        parser.parsed_lines += parsed_lines
+        parser.skipped_lines += skipped_lines
+        if last_msec > parser.last_msec:
+            parser.last_msec = last_msec
+        if bucket:
+            parser.bucket = bucket
+        for bucket in sorted(partial):
+            acc = fold_accumulator(partial[bucket], bucket, parser.vhosts,
+                                   parser.upstreams)
+            if parser.mbs is not None and bucket <= passed:
+                parser.late_lines += bucket_hits(acc) // parser.sample_rate
+            if bucket in storage:
+                storage[bucket].merge(acc)
+            else:
+                storage[bucket] = acc
+    tailer.skip_to(ranges[-1][1])
+    parser.process_passed()
+
+
+def sample_rate(tailer, filestatus, options):
+    """Returns N, to parse only 1 line in N, when falling behind: more than
+    sample threshold bytes pending, or the last line parsed more than sample
+    lag seconds old, N grows with backlog or lag so each run parses about
+    the same amount of lines"""
+    rate = 1
+    if options.sample_threshold:
+        behind = tailer.bytes_behind()
+        rate = max(rate, int(math.ceil(float(behind) / options.sample_threshold)))
+    if options.sample_lag and filestatus['last_msec']:
+        lag = time() - filestatus['last_msec']
+        rate = max(rate, int(math.ceil(lag / options.sample_lag)))
+    return max(1, min(rate, options.max_sample_rate))
+
+
+def parsefile(tailer, status, filestatus, options, flush=None):
+    """Parses new lines of tailer, returns processed buckets in mbs and
+    leftover buckets, if flush is set, it is called with processed buckets
+    each time there are enough of them to fill a batch, so they can be sent
+    while parsing goes on"""
+    parsed_lines = 0
+    skipped_lines = 0
+    late_lines = 0
     first_run = False
     max_lines = options.max_lines
     bucket_duration = status['bucket_duration']
     lookback_factor = status['lookback_factor']
-    mbs = mbsdict()
-    # lines are logged when request ends, which means they can be unordered
-    if not status['last_msec']:
+    corrections = filestatus.get('corrections')
+    grace = corrections.grace if corrections is not None else 0
+    topk = filestatus.get('topk', dict())
+    mbs = dict()
+    # lines are logged when request ends, which means they can be unordered,
+    # lines of buckets processed already are too late, unless they are
+    # within grace buckets, see Corrections
+    if not filestatus['last_msec']:
         ignore_before = 0
     else:
-        ignore_before = status['last_msec'] - bucket_duration * lookback_factor
+        ignore_before = (int(math.ceil(filestatus['last_msec'] / bucket_duration))
+                         - lookback_factor - grace) * bucket_duration
     logger.debug(
         "max_lines=%d bucket_duration=%d lookback_factor=%d ignore_before=%f" %
         (max_lines, bucket_duration, lookback_factor, ignore_before))
-    last_msec = 0
-    last_bucket = 0
-    if status['leftover'] is not None:
-        logger.debug("Examining %d leftovers" % len(status['leftover']))
-        storage = status['leftover']
+    # keep previous value if no line is parsed (idle ticks in daemon mode)
+    last_msec = filestatus['last_msec']
+    if filestatus['leftover'] is not None:
+        logger.debug("Examining %d leftovers" % len(filestatus['leftover']))
+        storage = filestatus['leftover']
         if options.quiet < 2:
             for bucket in storage:
                 logger.info("Previous leftover bucket: %s %d" %
-                            (bucket2time(bucket, status), len(storage[bucket])))
+                            (bucket2time(bucket, status),
+                             bucket_hits(storage[bucket])))
     else:
-        storage = defaultdict(deque)
-        logger.info("First run")
+        storage = dict()
+        logger.info("First run: %s" % tailer.filename)
         first_run = not options.do_not_skip_to_end
     bucket = 0
-    if first_run:
+    if first_run and max_lines:
         # code duplication here, intentional
-        try:
-            for line in tailer:
+        for lines in tailer.batches(max_lines):
+            for line in lines:
                 parsed_lines += 1
                 try:
                     items = line.split('|', 2)
@@ -264,203 +2021,494 @@ def parsefile(tailer, status, options):
                 except ValueError as e:
                     logger.error(str(e), line)
                     raise
-                if parsed_lines == max_lines:
-                    raise ParseEnd
-        except ParseEnd:
-            pass
         # ensure we start on an entire bucket, so values are correct
         last_msec = (bucket+lookback_factor) * bucket_duration
         skipped_lines = parsed_lines
         logger.info("End of first run: bucket=%d last_msec=%f skipped=%d" %
                      (bucket, last_msec, skipped_lines))
-    else:
-        try:
-            for line in tailer:
-                parsed_lines += 1
-                try:
-                    items = line.split('|')
-                    msec = float(items[pos_msec])
-                    if msec <= ignore_before:
-                        # skip unordered & old entries
-                        raise ParseSkip
-                    if msec > last_msec:
-                        last_msec = msec
-                    bucket = int(math.ceil(msec/bucket_duration))
-
-                    row = {
-                        'vhost': items[pos_vhost],
-                        'protocol': items[pos_protocol],
-                        'loctag': items[pos_loctag],
-                        'status': int(items[pos_status]),
-                        'bytes_sent': int(items[pos_bytes_sent]),
-                        'request_length': int(items[pos_request_length]),
-                    }
-
-                    if items[pos_gzip_ratio] != '-':
-                        row['gzip_ratio'] = float(items[pos_gzip_ratio])
-                    if items[pos_request_time] != '-':
-                        row['request_time'] = float(items[pos_request_time])
-
-                    if items[pos_upstream_addr] != '-':
-                        # Note : last element contains trailing new line character
-                        # from readline()
-                        row['upstreams'] = parse_upstreams({
-                        'upstream_addr': items[pos_upstream_addr],
-                        'upstream_status': items[pos_upstream_status],
-                        'upstream_response_time': items[pos_upstream_response_time],
-                        'upstream_connect_time': items[pos_upstream_connect_time],
-                        'upstream_header_time': items[pos_upstream_header_time].rstrip('\r\n'),
-                        })
-
-                    storage[bucket].append(row)
-                    ready_to_process = bucket - lookback_factor
-
-                    if storage[ready_to_process]:
-                        if options.quiet < 2:
-                            logger.info("Processing bucket: %s %d" %
-                                        (bucket2time(ready_to_process, status),
-                                         len(storage[ready_to_process])))
-                        process_bucket(ready_to_process, storage, status, mbs)
-                except ParseSkip:
-                    skipped_lines += 1
-                    pass
-                except Exception as e:
-                    logger.error("%s: %s", line)
-                    raise
-                if parsed_lines == max_lines:
-                    raise ParseEnd
-        except ParseEnd:
-            pass
+    elif first_run:
+        # only last line matters, no need to read the whole file
+        start = tailer.offset
+        line = tailer.skip_to_last_line()
+        if line is not None:
+            try:
+                bucket = int(math.ceil(raw_line_msec(line)/bucket_duration))
+            except ValueError as e:
+                logger.error("%s: %r", e, line)
+                raise
+        if options.first_run_buckets and line is not None:
+            # start from the line logged at beginning of a previous bucket
+            # instead, and parse from there, lines are unordered, so lines
+            # of that bucket may have been logged up to lookback_factor
+            # buckets earlier: seek there, lines before are still ignored
+            ignore_before = (bucket - options.first_run_buckets) * bucket_duration
+            tailer.seek_line(raw_line_msec,
+                             ignore_before - lookback_factor * bucket_duration,
+                             start)
+            last_msec = ignore_before
+            first_run = False
+            logger.info("First run: starting at bucket=%s, skipped %d bytes" %
+                        (bucket2time(bucket - options.first_run_buckets + 1, status),
+                         tailer.offset - start))
+        else:
+            # ensure we start on an entire bucket, so values are correct
+            last_msec = (bucket+lookback_factor) * bucket_duration
+            logger.info("End of first run: bucket=%d last_msec=%f skipped %d bytes" %
+                         (bucket, last_msec, tailer.offset - start))
+    if not first_run:
+        rate = sample_rate(tailer, filestatus, options)
+        if rate != filestatus.get('sample_rate', 1):
+            logger.info("Parsing 1 line in %d of %s, %d bytes pending" %
+                        (rate, tailer.filename, tailer.bytes_behind()))
+        filestatus['sample_rate'] = rate
+        parser = LineParser(storage, bucket_duration, ignore_before,
+                            last_msec, lookback_factor, mbs, status,
+                            options.quiet, topk.get('vhost'),
+                            topk.get('upstream'),
+                            list(filestatus.get('rollups', dict()).values()),
+                            options.engine, corrections, rate)
+        parser.bucket = bucket
+        def flush_processed():
+            if flush is None or mbs_size(parser.mbs) < options.influx_batch_size:
+                return
+            flush(parser.mbs)
+            parser.mbs = dict()
+
+        if (not max_lines and options.catchup_threshold
+                and tailer.pending_bytes() >= options.catchup_threshold):
+            # workers read and parse
+            with runstats.timer('parse'):
+                catchup(tailer, parser, options)
+            flush_processed()
+        for lines in runstats.timed('read', tailer.batches(max_lines)):
+            with runstats.timer('parse'):
+                parser.parse(lines)
+            flush_processed()
+        # buckets corrected by late lines are sent now
+        parser.process_passed()
+        mbs = parser.mbs
+        parsed_lines = parser.parsed_lines
+        skipped_lines = parser.skipped_lines
+        late_lines = parser.late_lines
+        last_msec = parser.last_msec
         if skipped_lines and options.quiet < 2:
-            logger.info("Skipped %d unordered lines" % skipped_lines)
+            logger.info("Skipped %d lines too late" % skipped_lines)
+        if late_lines and options.quiet < 2:
+            logger.info("Corrected buckets with %d late lines" % late_lines)
 
-    tailer._update_offset_file()
-    last_bucket = bucket
-    leftover = defaultdict(deque)
-    for bucket in storage:
-        if storage[bucket] and bucket >= last_bucket - lookback_factor:
-            leftover[bucket] = storage[bucket]
+    # buckets the watermark didn't pass yet
+    leftover = dict(storage)
 
     logger.debug("Leftovers %d" % len(leftover))
     if options.quiet < 2:
         for bucket in leftover:
             logger.info("Unprocessed bucket: %s %d" % (bucket2time(bucket,
                                                                    status),
-                                                       len(leftover[bucket])))
-
-    mbspostprocess(mbs)
-    return (mbs, leftover, last_msec, parsed_lines, skipped_lines)
-
-
-def mbsdict():
-    return {
-        'bytes_sent': defaultdict(int),
-        'gzip_count': defaultdict(int),
-        'gzip_count_percent': defaultdict(float),
-        'gzip_ratio_mean': defaultdict(float),
-        '_gzip_ratio_premean': defaultdict(float),
-        'hits': defaultdict(int),
-        'hits_with_upstream': defaultdict(int),
-        'request_length_mean': defaultdict(float),
-        '_request_length_premean': defaultdict(int),
-        'request_time_mean': defaultdict(float),
-        '_request_time_premean': defaultdict(float),
-        'status': defaultdict(int),
-        'upstreams_connect_time_mean': defaultdict(float),
-        '_upstreams_connect_time_premean': defaultdict(float),
-        'upstreams_header_time_mean': defaultdict(float),
-        '_upstreams_header_time_premean': defaultdict(float),
-        'upstreams_hits': defaultdict(int),
-        '_upstreams_internal_redirects': defaultdict(int),
-        'upstreams_internal_redirects_per_hit': defaultdict(int),
-        'upstreams_response_time_mean': defaultdict(float),
-        '_upstreams_response_time_premean': defaultdict(float),
-        '_upstreams_servers_contacted': defaultdict(int),
-        'upstreams_servers_contacted_per_hit': defaultdict(float),
-        'upstreams_servers': defaultdict(int),
-        'upstreams_status': defaultdict(int),
-    }
-
-
-def process_bucket(bucket, storage, status, mbs):
-    while True:
+                                                       bucket_hits(leftover[bucket])))
+
+    return (mbs, leftover, last_msec, parsed_lines, skipped_lines, late_lines)
+
+
+class Table(object):
+    """Accumulated values of measurements sharing a tag set
+
+    Each distinct tags tuple is given a row id, its index in value columns
+    (arrays, of typecodes of columns) and sketch columns (lists of
+    LatencySketch, None until a value is added).
+    """
+    def __init__(self, columns, sketches=()):
+        # tags -> row id
+        self.ids = dict()
+        self.tags = []
+        self.columns = dict((name, array(typecode)) for name, typecode in columns)
+        self.sketches = dict((name, []) for name in sketches)
+
+    def __getstate__(self):
+        return (self.tags, self.columns, self.sketches)
+
+    def __setstate__(self, state):
+        self.tags, self.columns, self.sketches = state
+        self.ids = dict((tags, row) for row, tags in enumerate(self.tags))
+
+    def add(self, tags):
+        """Adds a row of zero values, returns its id"""
+        row = len(self.tags)
+        self.ids[tags] = row
+        self.tags.append(tags)
+        for values in self.columns.values():
+            values.append(0)
+        for sketches in self.sketches.values():
+            sketches.append(None)
+        return row
+
+    def extend(self, tags):
+        """Adds rows of zero values for tags, none of them in table yet"""
+        first = len(self.tags)
+        self.ids.update(zip(tags, range(first, first + len(tags))))
+        self.tags.extend(tags)
+        for values in self.columns.values():
+            values.extend(array(values.typecode, [0]) * len(tags))
+        for sketches in self.sketches.values():
+            sketches.extend([None] * len(tags))
+
+    def row(self, tags):
         try:
-            row = storage[bucket].pop()
-
-            tags = (bucket, row['vhost'], row['protocol'], row['loctag'])
-            mbs['hits'][tags] += 1
-            mbs['bytes_sent'][tags] += row['bytes_sent']
-
-            if 'gzip_ratio' in row:
-                mbs['gzip_count'][tags] += 1
-                mbs['_gzip_ratio_premean'][tags] += row['gzip_ratio']
-
-            mbs['_request_length_premean'][tags] += row['request_length']
-            mbs['_request_time_premean'][tags] += row['request_time']
-
-            tags = (bucket, row['vhost'], row['protocol'], row['loctag'], row['status'])
-            mbs['status'][tags] += 1
-
-            if 'upstreams' in row:
-                ru = row['upstreams']
-
-                tags = (bucket, row['vhost'], row['protocol'], row['loctag'])
-                mbs['hits_with_upstream'][tags] += 1
-                mbs['_upstreams_servers_contacted'][tags] += ru['servers_contacted']
-                mbs['_upstreams_internal_redirects'][tags] += ru['internal_redirects']
-                mbs['upstreams_servers'][tags] += len(ru['servers'])
-                for upstream in ru['servers']:
-                    tags = (bucket, row['vhost'], row['protocol'], row['loctag'], upstream)
-                    mbs['upstreams_hits'][tags] += 1
-                    mbs['_upstreams_response_time_premean'][tags] += ru['response_time'][upstream]
-                    mbs['_upstreams_connect_time_premean'][tags] += ru['connect_time'][upstream]
-                    mbs['_upstreams_header_time_premean'][tags] += ru['header_time'][upstream]
-                    for status in ru['status'][upstream]:
-                        tags = (bucket, row['vhost'], row['protocol'], row['loctag'],
-                                upstream, status)
-                        mbs['upstreams_status'][tags] += 1
-        except IndexError:
-            break
-
-
-def mbspostprocess(mbs):
-    if mbs['gzip_count']:
-        for k, v in mbs['_gzip_ratio_premean'].items():
-            mbs['gzip_ratio_mean'][k] = v / mbs['gzip_count'][k]
-
-    if mbs['hits']:
-        for k, v in mbs['_request_length_premean'].items():
-            mbs['request_length_mean'][k] = v / mbs['hits'][k]
-
-        for k, v in mbs['_request_time_premean'].items():
-            mbs['request_time_mean'][k] = v / mbs['hits'][k]
-
-        for k, v in mbs['hits'].items():
-            if mbs['gzip_count'] and v:
-                mbs['gzip_count_percent'][k] = (mbs['gzip_count'][k] * 1.0) / v
+            return self.ids[tags]
+        except KeyError:
+            return self.add(tags)
+
+    def increment(self, tags, column, value=1):
+        self.columns[column][self.row(tags)] += value
+
+    def merge(self, other):
+        """Adds values of other table, rows are matched by tags, sketches
+        are copied, never shared"""
+        columns = [(self.columns[name], values)
+                   for name, values in other.columns.items()]
+        sketches = [(self.sketches[name], values)
+                    for name, values in other.sketches.items()]
+        row = self.row
+        for other_row, tags in enumerate(other.tags):
+            target = row(tags)
+            for values, other_values in columns:
+                values[target] += other_values[other_row]
+            for values, other_values in sketches:
+                sketch = other_values[other_row]
+                if sketch is None:
+                    continue
+                if values[target] is None:
+                    values[target] = LatencySketch()
+                values[target] += sketch
+
+
+class Accumulator(object):
+    """Accumulated values of one bucket (or rollup window), a Table per tag
+    set of mbs_tags
+
+    Means, quantiles and ratios aren't stored, they are computed from sums
+    and sketches by measurements(). sample_rate is the highest rate lines
+    were sampled at (see LineParser), values of sampled buckets are scaled.
+    """
+    # attribute and tag names of tables, with extra tags of log formats
+    tables = accumulator_tables
+    # class attribute, so accumulators pickled before have it too
+    sample_rate = 1
+
+    def __init__(self):
+        self.requests = Table((
+            ('hits', int_typecode),
+            ('bytes_sent', int_typecode),
+            ('_request_length_premean', int_typecode),
+            ('gzip_count', int_typecode),
+            ('_gzip_ratio_premean', 'd'),
+            ('_request_time_premean', 'd'),
+            ('hits_with_upstream', int_typecode),
+            ('_upstreams_servers_contacted', int_typecode),
+            ('_upstreams_internal_redirects', int_typecode),
+            ('upstreams_servers', int_typecode),
+        ) + self.extra_columns(), ('request_time', ))
+        self.status = Table((('status', int_typecode), ))
+        self.upstreams = Table((
+            ('upstreams_hits', int_typecode),
+            ('_upstreams_response_time_premean', 'd'),
+            ('_upstreams_connect_time_premean', 'd'),
+            ('_upstreams_header_time_premean', 'd'),
+        ), ('upstreams_response_time', 'upstreams_connect_time',
+            'upstreams_header_time'))
+        self.upstreams_status = Table((('upstreams_status', int_typecode), ))
+        self.folded = Table((('cardinality_folded_hits', int_typecode), ))
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # log formats may declare other extra fields than when pickled
+        table = self.requests
+        for name, typecode in self.extra_columns():
+            if name not in table.columns:
+                table.columns[name] = array(typecode, [0]) * len(table.tags)
+        # folded hits were pickled as cardinality_folded before
+        columns = self.folded.columns
+        if 'cardinality_folded' in columns:
+            columns['cardinality_folded_hits'] = columns.pop('cardinality_folded')
+
+    @staticmethod
+    def extra_columns():
+        """Returns sum and count columns of extra fields of log formats"""
+        columns = []
+        for name, type_ in sorted(extra_fields.items()):
+            columns.append((name + '_sum', field_typecodes[type_]))
+            columns.append(('_%s_count' % name, int_typecode))
+        return tuple(columns)
+
+    def merge(self, other):
+        for name, tagnames in self.tables:
+            getattr(self, name).merge(getattr(other, name))
+        if self.sample_rate < other.sample_rate:
+            self.sample_rate = other.sample_rate
+
+    def hits(self):
+        return sum(self.requests.columns['hits'])
+
+    def size(self):
+        """Returns number of values measurements() yields, at most"""
+        return sum(len(getattr(self, name).tags) * values_per_row[tagnames]
+                   for name, tagnames in self.tables)
+
+    def measurements(self):
+        """Yields (measurement, [(tags, value), ...]) for measurements of
+        mbs_tags"""
+        table = self.requests
+        tags = table.tags
+        columns = table.columns
+        rows = range(len(tags))
+        hits = columns['hits']
+        for name in ('hits', 'bytes_sent', 'gzip_count'):
+            yield (name, zip(tags, columns[name]))
+        gzip_count = columns['gzip_count']
+        yield ('gzip_count_percent',
+               [(tags[i], (gzip_count[i] * 1.0) / hits[i]) for i in rows])
+        premean = columns['_gzip_ratio_premean']
+        yield ('gzip_ratio_mean',
+               [(tags[i], premean[i] / gzip_count[i]) for i in rows if gzip_count[i]])
+        premean = columns['_request_length_premean']
+        yield ('request_length_mean',
+               [(tags[i], premean[i] / hits[i]) for i in rows])
+        for name in sorted(extra_fields):
+            sums = columns[name + '_sum']
+            counts = columns['_%s_count' % name]
+            present = [i for i in rows if counts[i]]
+            yield (name + '_sum', [(tags[i], sums[i]) for i in present])
+            yield (name + '_mean',
+                   [(tags[i], float(sums[i]) / counts[i]) for i in present])
+        for values in self._timings(table, 'request_time', hits):
+            yield values
+        hits_with_upstream = columns['hits_with_upstream']
+        with_upstream = [i for i in rows if hits_with_upstream[i]]
+        for name in ('hits_with_upstream', 'upstreams_servers'):
+            values = columns[name]
+            yield (name, [(tags[i], values[i]) for i in with_upstream])
+        for name in ('servers_contacted', 'internal_redirects'):
+            values = columns['_upstreams_%s' % name]
+            yield ('upstreams_%s_per_hit' % name,
+                   [(tags[i], float(values[i]) / hits_with_upstream[i])
+                    for i in with_upstream])
+
+        table = self.upstreams
+        upstreams_hits = table.columns['upstreams_hits']
+        yield ('upstreams_hits', zip(table.tags, upstreams_hits))
+        for name in ('response_time', 'connect_time', 'header_time'):
+            for values in self._timings(table, 'upstreams_' + name, upstreams_hits):
+                yield values
+
+        yield ('status', zip(self.status.tags, self.status.columns['status']))
+        table = self.upstreams_status
+        yield ('upstreams_status', zip(table.tags, table.columns['upstreams_status']))
+        table = self.folded
+        yield ('cardinality_folded_hits', zip(table.tags, table.columns['cardinality_folded_hits']))
+
+    @staticmethod
+    def _timings(table, name, counts):
+        """Yields mean, quantiles and max of name, for rows with a sketch,
+        quantiles and max only if a value was added to it"""
+        tags = table.tags
+        premean = table.columns['_%s_premean' % name]
+        sketches = table.sketches[name]
+        rows = [i for i, sketch in enumerate(sketches) if sketch is not None]
+        yield ('%s_mean' % name, [(tags[i], premean[i] / counts[i]) for i in rows])
+        # rows whose timings were all absent have no quantile
+        rows = [i for i in rows if sketches[i].count]
+        for suffix, quantile in sketch_quantiles:
+            yield ('%s_%s' % (name, suffix),
+                   [(tags[i], sketches[i].quantile(quantile)) for i in rows])
+        yield ('%s_max' % name, [(tags[i], sketches[i].max) for i in rows])
+
+
+def mbs_size(mbs):
+    return sum(acc.size() for acc in mbs.values())
+
+
+def bucket_hits(acc):
+    return acc.hits()
+
+
+def fold_tags(topk, bucket, table, index, column):
+    """Folds values of tags[index] of table rows by topk, each once, with
+    its sum of column, in order of rows, returns value -> folded value and
+    the sum folded into other_tag"""
+    values = []
+    counts = dict()
+    for tags, count in zip(table.tags, table.columns[column]):
+        value = tags[index]
+        if value not in counts:
+            values.append(value)
+            counts[value] = 0
+        counts[value] += count
+    names = dict()
+    folded = 0
+    for value in values:
+        name = names[value] = topk.fold(value, bucket, counts[value])
+        if name == other_tag:
+            folded += counts[value]
+    return names, folded
+
+
+def fold_accumulator(acc, bucket, vhosts=None, upstreams=None):
+    """Returns acc of bucket, parsed without TopKs, with its vhosts and
+    upstreams folded by vhosts and upstreams (TopK), rows left with the same
+    tags are merged. Values are folded with their totals over the bucket,
+    not line by line, so this is an approximation: folds can differ from
+    those of parsing the same lines with the TopKs"""
+    renames = []
+    if vhosts is not None:
+        names, folded = fold_tags(vhosts, bucket, acc.requests, 0, 'hits')
+        renames.append(('vhost', names))
+        if folded:
+            acc.folded.increment(('vhost', ), 'cardinality_folded_hits', folded)
+    if upstreams is not None:
+        index = dict(acc.tables)['upstreams'].index('upstream')
+        names, folded = fold_tags(upstreams, bucket, acc.upstreams, index,
+                                  'upstreams_hits')
+        renames.append(('upstream', names))
+        if folded:
+            acc.folded.increment(('upstream', ), 'cardinality_folded_hits', folded)
+    if not renames:
+        return acc
+    for name, tagnames in acc.tables:
+        table = getattr(acc, name)
+        for tagname, names in renames:
+            if tagname in tagnames:
+                i = tagnames.index(tagname)
+                # ids are left stale, acc is only merged from below
+                table.tags = [tags[:i] + (names[tags[i]], ) + tags[i + 1:]
+                              for tags in table.tags]
+    folded = Accumulator()
+    folded.merge(acc)
+    return folded
+
+
+def process_bucket(bucket, storage, status, mbs, rollups=None,
+                   corrections=None):
+    """Moves accumulator of bucket from storage to mbs (bucket -> Accumulator),
+    merging it if bucket is there already, and adds it to rollups, if
+    corrections are set, a bucket processed again is sent again, whole"""
+    acc = storage.pop(bucket)
+    if corrections is not None:
+        mbs[bucket] = corrections.add(bucket, acc)
+    elif bucket in mbs:
+        mbs[bucket].merge(acc)
+    else:
+        mbs[bucket] = acc
+    if rollups:
+        for rollup in rollups:
+            rollup.add(bucket, acc, status['bucket_duration'])
+
+
+# measurement name prefix of rollups, formatted with rollup label
+rollup_prefix = 'rollup_%s_'
+
+def parse_rollups(text, bucket_duration):
+    """Returns (seconds, label) of comma separated durations, like 5m,1h,1d,
+    raises ValueError if one isn't a multiple of bucket_duration"""
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    rollups = []
+    for label in text.split(','):
+        label = label.strip()
+        if not label:
+            continue
+        try:
+            seconds = int(label[:-1]) * units[label[-1]]
+        except (KeyError, ValueError):
+            raise ValueError("Invalid rollup duration %r" % label)
+        if seconds <= bucket_duration or seconds % bucket_duration:
+            raise ValueError("Rollup duration %r isn't a multiple of bucket duration %d" %
+                             (label, bucket_duration))
+        rollups.append((seconds, label))
+    return rollups
+
+
+class Rollup(object):
+    """Accumulators of a coarser resolution than buckets
+
+    Processed buckets are merged into the window of seconds they belong to
+    (ending at window * seconds, as buckets do), a window is ready to be sent
+    once a bucket of a later window is processed. Buckets of windows already
+    sent are ignored, and so are those of the window a rollup starts in,
+    unless it starts on its first bucket, so partial windows are never sent.
+    """
+    def __init__(self, seconds, label):
+        self.seconds = seconds
+        self.label = label
+        self.prefix = rollup_prefix % label
+        # window -> Accumulator
+        self.windows = dict()
+        # last window sent or skipped
+        self.done = None
+        # window -> Accumulator, of windows ready to be sent
+        self.ready = None
+
+    def add(self, bucket, acc, bucket_duration):
+        end = bucket * bucket_duration
+        window = -(-end // self.seconds)
+        if self.done is None:
+            if end - bucket_duration == (window - 1) * self.seconds:
+                self.done = window - 1
             else:
-                mbs['gzip_count_percent'][k] = 0.0
-
-    if mbs['upstreams_hits']:
-        for k, v in mbs['_upstreams_response_time_premean'].items():
-            mbs['upstreams_response_time_mean'][k] = v / mbs['upstreams_hits'][k]
-
-        for k, v in mbs['_upstreams_connect_time_premean'].items():
-            mbs['upstreams_connect_time_mean'][k] = v / mbs['upstreams_hits'][k]
-
-        for k, v in mbs['_upstreams_header_time_premean'].items():
-            mbs['upstreams_header_time_mean'][k] = v / mbs['upstreams_hits'][k]
-
-        for k, v in mbs['_upstreams_servers_contacted'].items():
-            mbs['upstreams_servers_contacted_per_hit'][k] = float(v) / mbs['hits_with_upstream'][k]
+                logger.info("Rollup %s: skipping partial window %d" %
+                            (self.label, window))
+                self.done = window
+        if window <= self.done:
+            return
+        for previous in sorted(self.windows):
+            if previous < window:
+                if self.ready is None:
+                    self.ready = dict()
+                process_bucket(previous, self.windows, None, self.ready)
+                self.done = previous
+        if window not in self.windows:
+            self.windows[window] = Accumulator()
+        self.windows[window].merge(acc)
+
+    def pop_ready(self):
+        """Returns mbs of windows ready to be sent, or None"""
+        ready, self.ready = self.ready, None
+        return ready
+
+
+class Corrections(object):
+    """Accumulators of the last grace buckets processed
+
+    Lines of these buckets parsed after they were processed (late lines) are
+    merged into them, and the whole bucket is sent again: InfluxDB keeps the
+    last point sent for a series and timestamp, so it is corrected, as long
+    as it is sent after points sent before (Sender.send_after). Windows of
+    rollups sent already aren't corrected.
+    """
+    def __init__(self, grace):
+        self.grace = grace
+        # bucket -> Accumulator
+        self.buckets = dict()
+        # buckets corrected since pop_corrected() was last called
+        self.corrected = set()
+
+    def add(self, bucket, acc):
+        """Returns accumulator of bucket to send, acc itself, or the one
+        processed previously corrected by acc"""
+        buckets = self.buckets
+        if bucket in buckets:
+            buckets[bucket].merge(acc)
+            logger.debug("Correcting bucket %d with %d late hits" %
+                         (bucket, acc.hits()))
+            self.corrected.add(bucket)
+            return buckets[bucket]
+        buckets[bucket] = acc
+        for previous in [b for b in buckets if b <= bucket - self.grace]:
+            del buckets[previous]
+        return acc
+
+    def pop_corrected(self):
+        """Returns buckets corrected since last call"""
+        corrected, self.corrected = self.corrected, set()
+        return corrected
 
-        for k, v in mbs['_upstreams_internal_redirects'].items():
-            mbs['upstreams_internal_redirects_per_hit'][k] = float(v) / mbs['hits_with_upstream'][k]
-
-def save_obj(obj, filepath):
-    with open(filepath, 'wb') as f:
-        pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
-        logger.debug("save_obj(): saved to %r" % filepath)
 
 def load_obj(filepath):
     with open(filepath, 'rb') as f:
@@ -474,57 +2522,142 @@ def bucket2time(bucket, status):
     )
     return d.isoformat() + 'Z'
 
-def mbs2influx(mbs, status):
-    extra_tags = dict()
-    points = []
-    for measurement, tagnames in mbs_tags.items():
-        if not measurement in mbs:
-            continue
-        for tags, value in mbs[measurement].items():
-            influxtags = dict(zip(tagnames, tags[1:]))
-            for k, v in influxtags.items():
-                if k == 'protocol':
-                    if v == 's':
-                        influxtags[k] = 'https'
+def escape_tag(value):
+    return value.replace('\\', '\\\\').replace(' ', '\\ ').replace(
+        ',', '\\,').replace('=', '\\=').replace('\n', '\\n')
+
+
+class LineEncoder(object):
+    """Encodes mbs (bucket -> Accumulator) to InfluxDB line protocol
+
+    Series keys (measurement and tag set) are cached per tag tuple, tags
+    contain extra tags, timestamps are in seconds. If consolidated is set,
+    measurements sharing a tag set of consolidated_measurements are written
+    as fields of a single point. Points of sampled buckets have a
+    sample_rate field, the rate their values were scaled by.
+    """
+    cache_max_size = 100000
+
+    def __init__(self, extra_tags, consolidated=False):
+        self.extra_tags = extra_tags
+        self.consolidated = consolidated
+        self.series = dict()
+
+    def series_key(self, measurement, tagnames, tags):
+        key = (measurement, tags)
+        try:
+            return self.series[key]
+        except KeyError:
+            pass
+        # protocol values are sent as logged ('-' or 's'), as they always
+        # were, so existing series are kept
+        influxtags = dict(zip(tagnames, tags))
+        influxtags.update(self.extra_tags)
+        parts = [escape_tag(measurement)]
+        for k in sorted(influxtags):
+            v = escape_tag(str(influxtags[k]))
+            if v:
+                parts.append('%s=%s' % (escape_tag(k), v))
+        if len(self.series) >= self.cache_max_size:
+            self.series.clear()
+        series = self.series[key] = ','.join(parts)
+        return series
+
+    def encode(self, mbs, status, bucket_duration=None, prefix=''):
+        """Returns lines sorted by series key, then time, buckets of mbs
+        last bucket_duration (status one by default), measurement names are
+        prefixed with prefix"""
+        if bucket_duration is None:
+            bucket_duration = status['bucket_duration']
+        series_key = self.series_key
+        # (series key, bucket) -> fields
+        points = defaultdict(list)
+        # (series key, bucket) -> sample rate, of sampled buckets
+        rates = dict()
+        for bucket, acc in mbs.items():
+            rate = acc.sample_rate
+            for measurement, values in acc.measurements():
+                tagnames = mbs_tags[measurement]
+                name = 'value'
+                if self.consolidated and tagnames in consolidated_measurements:
+                    name = measurement
+                    measurement = consolidated_measurements[tagnames]
+                measurement = prefix + measurement
+                for tags, value in values:
+                    if isinstance(value, float):
+                        field = '%s=%r' % (name, value)
                     else:
-                        influxtags[k] = 'http'
-                influxtags[k] = str(v)
-            fields = { 'value': value}
-            points.append({
-                "measurement": measurement,
-                "tags": influxtags,
-                "time": bucket2time(tags[0], status),
-                "fields": fields
-            })
-    return points
+                        field = '%s=%di' % (name, value)
+                    key = (series_key(measurement, tagnames, tags), bucket)
+                    points[key].append(field)
+                    if rate > 1:
+                        rates[key] = rate
+        for key, rate in rates.items():
+            points[key].append('sample_rate=%di' % rate)
+        return ['%s %s %d' % (series, ','.join(sorted(points[(series, bucket)])),
+                              bucket * bucket_duration)
+                for series, bucket in sorted(points)]
+
+    def point(self, measurement, fields, timestamp):
+        """Returns line of a single point, tagged with extra tags only"""
+        values = []
+        for name in sorted(fields):
+            value = fields[name]
+            if isinstance(value, float):
+                values.append('%s=%r' % (name, value))
+            else:
+                values.append('%s=%di' % (name, value))
+        return '%s %s %d' % (self.series_key(measurement, (), ()),
+                             ','.join(values), timestamp)
 
 
 def influxdb_client(options):
+    return InfluxDBClient(host=options.influx_host,
+                          port=options.influx_port,
+                          username=options.influx_username,
+                          password=options.influx_password,
+                          database=options.influx_database,
+                          timeout=options.influx_timeout)
+
+
+def influxdb_setup(client, options):
     database = options.influx_database
-    client = InfluxDBClient(host=options.influx_host,
-                            port=options.influx_port,
-                            username=options.influx_username,
-                            password=options.influx_password,
-                            database=database,
-                            timeout=options.influx_timeout)
     if options.influx_drop_database:
         client.drop_database(database)
 
     client.create_database(database)
-    return client
 
-def influxdb_send(client, points, tags, options):
-    npoints = len(points)
-    if npoints:
+def gzip_compress(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def influxdb_send(client, lines, options):
+    """Writes line protocol lines, in batches, gzip compressed unless
+    disabled"""
+    nlines = len(lines)
+    if nlines:
         if options.quiet < 2:
-            logger.info("Sending %d points" % npoints)
-        logger.debug(points[0])
+            logger.info("Sending %d points" % nlines)
+        logger.debug(lines[0])
         if options.dry_run:
             logger.debug("Dry run")
-            print(json.dumps(points, indent=4, sort_keys=True))
+            print('\n'.join(lines))
             return True
-        return client.write_points(points, tags=tags, time_precision='m',
-                                   batch_size=options.influx_batch_size)
+        headers = {'Content-Type': 'application/octet-stream'}
+        if options.influx_gzip:
+            headers['Content-Encoding'] = 'gzip'
+        params = {'db': options.influx_database, 'precision': 's'}
+        batch_size = options.influx_batch_size or nlines
+        for start in range(0, nlines, batch_size):
+            data = '\n'.join(lines[start:start + batch_size]) + '\n'
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8')
+            if options.influx_gzip:
+                data = gzip_compress(data)
+            client.request(url='write', method='POST', params=params,
+                           data=data, expected_response_code=204,
+                           headers=headers)
     return True
 
 class LockingError(Exception):
@@ -583,68 +2716,1174 @@ class SafeFile(object):
         self.sane_filename = re.sub(r'\W', '_', self.identifier + self.suffix)
         self.workdir = workdir
         self.main = os.path.join(self.workdir, self.sane_filename)
-        self.tmp = "%s.%d.tmp" % (self.main, os.getpid())
+        # backup made by previous versions
         self.old = "%s.old" % (self.main)
-        self.lock = "%s.lock" % (self.main)
 
     def suffixed(self, suffix):
         return SafeFile(self.workdir, self.identifier, suffix='.' + suffix)
 
-    def main2old(self):
+    def remove_main(self):
+        for path in (self.main, self.old):
+            if os.path.isfile(path):
+                try:
+                    os.remove(path)
+                    logger.debug("remove_main(): Removed %r" % (path))
+                except Exception as e:
+                    logger.error("remove_main(): failed: %r %s" % (path, str(e)))
+                    pass
+
+
+def fsync_dir(path):
+    fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Journal(object):
+    """Append-only checkpoint store
+
+    Each commit appends one record holding only the keys whose value changed
+    since previous commit, and fsync()s once. Only keys marked by touch()
+    and keys new to the journal are pickled, so a commit costs what changed,
+    not the whole state: values changed in place must be touched. On load,
+    records are replayed in order, an incomplete or corrupted tail (crash
+    while writing) is discarded, so state is the one of the last complete
+    commit.
+    When journal grows too big compared to live data, it is compacted to a
+    single snapshot record by a background thread, records committed meanwhile
+    are appended to the compacted file before it replaces the journal.
+    """
+    header = struct.Struct('>4sBII')
+    magic = b'MBSJ'
+    version = 1
+
+    def __init__(self, path, compact_min_size=1024*1024, compact_ratio=4):
+        self.path = path
+        self.compact_path = path + '.compact'
+        self.compact_min_size = compact_min_size
+        self.compact_ratio = compact_ratio
+        # key -> pickled value, as last committed
+        self.blobs = dict()
+        self.size = 0
+        self.fd = None
+        self.compactor = None
+        self.compact_error = None
+        self.pending = None
+        # keys changed since last commit, see touch()
+        self.dirty = set()
+
+    def touch(self, *keys):
+        """Marks keys as changed, so next commit() writes their value"""
+        self.dirty.update(keys)
+
+    def load(self):
+        if os.path.isfile(self.compact_path):
+            # interrupted compaction, journal itself is still complete
+            os.unlink(self.compact_path)
+        good = 0
+        size = 0
         try:
-            if os.path.isfile(self.old):
-                os.unlink(self.old)
-            shutil.copy2(self.main, self.old)
-            logger.debug("main2old(): Copied %r to %r" % (self.main, self.old))
-        except Exception as e:
-            logger.warning("main2old() failed: %r -> %r %s" % (self.main, self.old,
-                                                               str(e)))
+            with open(self.path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                while True:
+                    record = self._read_record(f)
+                    if record is None:
+                        break
+                    if record['snapshot']:
+                        self.blobs = dict()
+                    self.blobs.update(record['set'])
+                    for key in record['del']:
+                        self.blobs.pop(key, None)
+                    good = f.tell()
+        except IOError:
             pass
+        if size > good:
+            logger.warning("Journal %r: discarding %d bytes of incomplete record" %
+                           (self.path, size - good))
+            with open(self.path, 'r+b') as f:
+                f.truncate(good)
+                os.fsync(f.fileno())
+        self.size = good
+        logger.debug("Journal %r: loaded %d keys, %d bytes" %
+                     (self.path, len(self.blobs), good))
+        return dict((k, pickle.loads(v)) for k, v in self.blobs.items())
+
+    def _read_record(self, f):
+        head = f.read(self.header.size)
+        if len(head) < self.header.size:
+            return None
+        magic, version, length, crc = self.header.unpack(head)
+        if magic != self.magic or version != self.version:
+            return None
+        payload = f.read(length)
+        if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+            return None
+        return pickle.loads(payload)
+
+    def _record(self, changed, deleted, snapshot=False):
+        payload = pickle.dumps({'set': changed, 'del': deleted,
+                                'snapshot': snapshot},
+                               pickle.HIGHEST_PROTOCOL)
+        return self.header.pack(self.magic, self.version, len(payload),
+                                zlib.crc32(payload) & 0xffffffff) + payload
+
+    def _append(self, data):
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                              0o644)
+        written = 0
+        while written < len(data):
+            written += os.write(self.fd, data[written:])
+        os.fsync(self.fd)
+        self.size += len(data)
+
+    def commit(self, state):
+        """Writes values of keys of state touched or new since last commit,
+        if they changed, and deletes keys missing from state, others are
+        left as they were"""
+        blobs = self.blobs
+        dirty, self.dirty = self.dirty, set()
+        dirty.update(key for key in state if key not in blobs)
+        changed = dict()
+        for key in dirty:
+            if key not in state:
+                continue
+            blob = pickle.dumps(state[key], pickle.HIGHEST_PROTOCOL)
+            if blobs.get(key) != blob:
+                changed[key] = blob
+        deleted = [key for key in blobs if key not in state]
+        if not changed and not deleted:
+            return False
+        record = self._record(changed, deleted)
+        self._append(record)
+        self.blobs.update(changed)
+        for key in deleted:
+            del self.blobs[key]
+        logger.debug("Journal %r: committed %d changed %d deleted, %d bytes" %
+                     (self.path, len(changed), len(deleted), len(record)))
+        if self.pending is not None:
+            self.pending.append(record)
+        if self.compactor is not None:
+            if not self.compactor.is_alive():
+                self._finish_compaction()
+        else:
+            live = sum(len(blob) for blob in self.blobs.values())
+            if self.size > max(self.compact_min_size, self.compact_ratio * live):
+                self._start_compaction()
+        return True
+
+    def _start_compaction(self):
+        logger.debug("Journal %r: compacting %d bytes" % (self.path, self.size))
+        snapshot = self._record(dict(self.blobs), [], snapshot=True)
+        self.pending = []
+        self.compact_error = None
+        self.compactor = threading.Thread(target=self._write_compact,
+                                          args=(snapshot, ))
+        self.compactor.start()
+
+    def _write_compact(self, snapshot):
+        try:
+            with open(self.compact_path, 'wb') as f:
+                f.write(snapshot)
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception as e:
+            self.compact_error = e
 
-    def tmp2main(self):
+    def _finish_compaction(self):
+        self.compactor.join()
+        self.compactor = None
+        pending, self.pending = self.pending, None
         try:
-            self.main2old()
-            os.rename(self.tmp, self.main)
-            logger.debug("tmp2main(): Renamed %r to %r" % (self.tmp, self.main))
+            if self.compact_error is not None:
+                raise self.compact_error
+            with open(self.compact_path, 'ab') as f:
+                f.write(b''.join(pending))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(self.compact_path, self.path)
+            fsync_dir(self.path)
         except Exception as e:
-            logger.error("tmp2main(): failed: %r -> %r %s" % (self.tmp, self.main,
-                                                          str(e)))
-            raise
+            logger.warning("Journal %r: compaction failed: %s" % (self.path, e))
+            if os.path.isfile(self.compact_path):
+                os.unlink(self.compact_path)
+            return
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.size = os.path.getsize(self.path)
+        logger.debug("Journal %r: compacted to %d bytes" % (self.path, self.size))
+
+    def close(self):
+        if self.compactor is not None:
+            self._finish_compaction()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class Spool(object):
+    """Points which could not be sent, kept on disk until sent
+
+    Each batch is written to its own gzip compressed segment, named after
+    an increasing sequence number, so segments are replayed in order and
+    deleted once sent. A segment is written to a temporary file then
+    renamed, so it is either complete or missing after a crash. When total
+    size exceeds max_size, oldest segments are dropped.
+    """
+    suffix = '.lp.gz'
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # segment name -> size in bytes
+        self.segments = dict()
+        self.sequence = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in os.listdir(path):
+            segment = os.path.join(path, name)
+            if not name.endswith(self.suffix):
+                # interrupted write
+                os.unlink(segment)
+                continue
+            self.segments[name] = os.path.getsize(segment)
+            self.sequence = max(self.sequence, int(name[:-len(self.suffix)]))
+
+    def __len__(self):
+        return len(self.segments)
+
+    def size(self):
+        return sum(self.segments.values())
+
+    def append(self, lines):
+        data = '\n'.join(lines) + '\n'
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        data = gzip_compress(data)
+        with self.lock:
+            self.sequence += 1
+            name = '%020d%s' % (self.sequence, self.suffix)
+            segment = os.path.join(self.path, name)
+            with open(segment + '.tmp', 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(segment + '.tmp', segment)
+            fsync_dir(segment)
+            self.segments[name] = len(data)
+            dropped = 0
+            while len(self.segments) > 1 and self.size() > self.max_size:
+                oldest = min(self.segments)
+                del self.segments[oldest]
+                os.unlink(os.path.join(self.path, oldest))
+                dropped += 1
+        if dropped:
+            logger.warning("Spool %r is full, dropped %d oldest segments" %
+                           (self.path, dropped))
+
+    def oldest(self, max_size):
+        """Returns names of oldest segments, up to max_size bytes, at least
+        one"""
+        names = []
+        total = 0
+        with self.lock:
+            for name in sorted(self.segments):
+                total += self.segments[name]
+                if names and total > max_size:
+                    break
+                names.append(name)
+        return names
+
+    def read(self, name):
+        with open(os.path.join(self.path, name), 'rb') as f:
+            data = zlib.decompress(f.read(), 16 + zlib.MAX_WBITS)
+        return split_lines(data)
+
+    def remove(self, name):
+        with self.lock:
+            if self.segments.pop(name, None) is not None:
+                os.unlink(os.path.join(self.path, name))
+
+
+def status2journal(status):
+    """Flatten status, so each log file status and each leftover bucket is
+    journaled on its own"""
+    state = dict()
+    for key, value in status.items():
+        if key != 'files':
+            state[key] = value
+            continue
+        for filename, filestatus in value.items():
+            for k, v in filestatus.items():
+                if k == 'leftover' and v is not None:
+                    # placeholder, buckets are stored under their own keys
+                    state[('file', filename, k)] = dict()
+                    for bucket, acc in v.items():
+                        state[('leftover', filename, bucket)] = acc
+                else:
+                    state[('file', filename, k)] = v
+    return state
+
+
+def touch_file(filename, filestatus, *names):
+    """Marks values of names in status of log file filename as changed, so
+    next checkpoint journals them, 'buckets' stands for its leftover
+    buckets, see Journal.touch()"""
+    for name in names:
+        if name == 'buckets':
+            journal.touch(*[('leftover', filename, bucket)
+                            for bucket in filestatus['leftover'] or ()])
+        else:
+            journal.touch(('file', filename, name))
+
+
+def journal2status(state):
+    status = dict()
+    files = dict()
+    leftovers = defaultdict(dict)
+    for key, value in state.items():
+        if not isinstance(key, tuple):
+            status[key] = value
+        elif key[0] == 'file':
+            files.setdefault(key[1], dict())[key[2]] = value
+        elif len(key) == 3:
+            leftovers[key[1]][key[2]] = value
+        else:
+            # single file layout of previous versions: ('leftover', bucket)
+            leftovers[None][key[1]] = value
+    if status.get('leftover') is not None:
+        status['leftover'] = leftovers[None]
+    for filename, filestatus in files.items():
+        if filestatus.get('leftover') is not None:
+            filestatus['leftover'] = leftovers[filename]
+    if files:
+        status['files'] = files
+    return status
+
+
+def read_offset_file(filepath):
+    try:
+        with open(filepath, 'r') as f:
+            inode, offset = [int(line.strip()) for line in f]
+            return (inode, offset)
+    except (IOError, ValueError):
+        return None
+
+
+def expand_files(patterns):
+    """Returns files matching patterns, patterns without wildcards are
+    returned as is, even if file doesn't exist"""
+    filenames = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+        else:
+            matches = [pattern]
+        for filename in matches:
+            if filename not in filenames:
+                filenames.append(filename)
+    return filenames
+
+
+def read_config(conf_path):
+    with open(conf_path, 'r') as f:
+        return json.load(f)
+
+
+def cleanup():
+    if sender is not None:
+        sender.close()
+    journal.close()
+    for logfile in logfiles:
+        logfile.close()
+    end_locking(lockfile, files['lock'].main)
+
+def checkpoint(status):
+    for logfile in logfiles:
+        logfile.status['offset'] = logfile.tailer.position()
+        touch_file(logfile.filename, logfile.status, 'offset')
+    # few and small, breaker state is changed in place by senders
+    journal.touch(*[key for key in status if key != 'files'])
+    with runstats.timer('status'):
+        journal.commit(status2journal(status))
+
+
+def load_status(options):
+    status = journal2status(journal.load())
+    imported = False
+    if not status and os.path.isfile(files['status'].main):
+        try:
+            status = load_obj(files['status'].main)
+            status['offset'] = read_offset_file(files['offset'].main)
+            imported = True
+            logger.info("Importing status from %s" % files['status'].main)
+        except Exception as e:
+            logger.warning("Cannot import status from %s: %s" %
+                           (files['status'].main, e))
+            status = {}
+
+    if not 'files' in status:
+        status['files'] = dict()
+        # single file status saved by previous versions
+        previous = dict((k, status.pop(k)) for k in ('offset', 'last_msec', 'leftover')
+                        if k in status)
+        if 'last_msec' in previous and len(filenames) == 1:
+            previous.setdefault('offset', None)
+            previous.setdefault('leftover', None)
+            status['files'][filenames[0]] = previous
+    for filestatus in status['files'].values():
+        drop_obsolete_buckets(filestatus)
+    for filename in list(status['files']):
+        if filename not in filenames and not os.path.exists(filename):
+            logger.info("Forgetting status of %s, file is gone" % filename)
+            del status['files'][filename]
+    if not 'bucket_duration' in status:
+        status['bucket_duration'] = options.bucket_duration
+    if not 'lookback_factor' in status:
+        status['lookback_factor'] = options.lookback_factor
+    # heavy hitters of all files, saved by previous versions
+    status.pop('topk', None)
+    if status.get('saved_points'):
+        lines = saved_lines(status, options)
+        logger.info("Moving %d saved points to spool" % len(lines))
+        batch_size = options.influx_batch_size or len(lines)
+        for start in range(0, len(lines), batch_size):
+            spool.append(lines[start:start + batch_size])
+        imported = True
+    status.pop('saved_points', None)
+
+    if imported:
+        journal.commit(status2journal(status))
+        files['offset'].remove_main()
+        files['status'].remove_main()
+
+    if [f for f in status['files'].values() if f['leftover']]:
+        exit = False
+        msg = 'Error:'
+        if status['bucket_duration'] != options.bucket_duration:
+            msg += (" Bucket duration mismatch %d vs %d (set via option)" %
+                  (status['bucket_duration'], options.bucket_duration))
+            exit = True
+        if status['lookback_factor'] != options.lookback_factor:
+            msg += (" Lookback factor mismatch %d vs %d (set via option)" %
+                  (status['lookback_factor'], options.lookback_factor))
+            exit = True
+        if exit:
+            msg += (" If you know what you are doing, remove journal file %s" % files['journal'].main)
+            logger.error(msg)
+            print(msg)
+            sys.exit(1)
+
+    return status
+
+
+def load_backfill_status(options):
+    status = journal2status(journal.load())
+    status.setdefault('files', dict())
+    if not 'bucket_duration' in status:
+        status['bucket_duration'] = options.bucket_duration
+    if (status['bucket_duration'] != options.bucket_duration
+            and [f for f in status['files'].values() if f['leftover']]):
+        msg = ("Error: Bucket duration mismatch %d vs %d (set via option)."
+               " If you know what you are doing, remove journal file %s" %
+               (status['bucket_duration'], options.bucket_duration,
+                files['journal'].main))
+        logger.error(msg)
+        print(msg)
+        sys.exit(1)
+    for filestatus in status['files'].values():
+        drop_obsolete_buckets(filestatus)
+    # heavy hitters of all files, saved by previous versions
+    status.pop('topk', None)
+    return status
+
+
+def drop_obsolete_buckets(filestatus):
+    """Drops leftover buckets and resets rollups saved by versions storing
+    raw rows (deque) or per-measurement dicts, instead of Accumulator"""
+    leftover = filestatus['leftover']
+    if leftover and not isinstance(list(leftover.values())[0], Accumulator):
+        logger.warning("Dropping %d leftover buckets in obsolete format" %
+                       len(leftover))
+        filestatus['leftover'] = dict()
+    rollups = filestatus.get('rollups', dict())
+    for seconds, rollup in list(rollups.items()):
+        windows = list(rollup.windows.values()) + list((rollup.ready or {}).values())
+        if windows and not isinstance(windows[0], Accumulator):
+            logger.warning("Resetting rollup %s in obsolete format" % rollup.label)
+            rollups[seconds] = Rollup(seconds, rollup.label)
+
+
+def setup_topk(filestatus, options):
+    # heavy hitters of a file are kept across runs, reset if cap changes, or
+    # if saved by previous versions, which didn't name values per bucket
+    topk = filestatus.setdefault('topk', dict())
+    for dimension, size in (('vhost', options.max_vhosts),
+                            ('upstream', options.max_upstreams)):
+        if not size:
+            topk.pop(dimension, None)
+        elif (dimension not in topk or topk[dimension].size != size
+              or not hasattr(topk[dimension], 'named')):
+            topk[dimension] = TopK(size)
+
+
+def setup_rollups(filestatus, status, options):
+    # rollups are kept across runs, reset if dropped from options
+    rollups = filestatus.setdefault('rollups', dict())
+    wanted = dict(parse_rollups(options.rollups, status['bucket_duration']))
+    for seconds in list(rollups):
+        if seconds not in wanted:
+            del rollups[seconds]
+    for seconds, label in wanted.items():
+        if seconds not in rollups:
+            rollups[seconds] = Rollup(seconds, label)
+
+
+def setup_corrections(filestatus, options):
+    # kept across runs, since late lines may come in the next one
+    corrections = filestatus.get('corrections')
+    if not options.grace_buckets:
+        filestatus.pop('corrections', None)
+    elif corrections is None:
+        filestatus['corrections'] = Corrections(options.grace_buckets)
+    else:
+        corrections.grace = options.grace_buckets
+        if not hasattr(corrections, 'corrected'):
+            # saved by a previous version
+            corrections.corrected = set()
 
-    def tmpclean(self):
-        if os.path.isfile(self.tmp):
-            try:
-                os.remove(self.tmp)
-                logger.debug("tmpclean(): Removed %r" % self.tmp)
-            except Exception as e:
-                logger.error("tmpclean(): failed: %r %s" % (self.tmp, str(e)))
-                pass
 
-    def main2tmp(self):
-        if os.path.isfile(self.main):
+def global_tags(options):
+    tags = {
+        'host': options.hostname,
+    }
+    if options.datacenter:
+        tags['dc'] = options.datacenter
+    return tags
+
+
+def saved_lines(status, options):
+    """Returns lines of points saved in status by previous versions after
+    failed sends"""
+    lines = list()
+    for savedpoints in status['saved_points']:
+        if savedpoints and isinstance(savedpoints[0], dict):
+            # points saved by previous versions, without global tags, and
+            # name tag if they predate multiple files
+            tags = global_tags(options)
+            if len(filenames) == 1:
+                tags['name'] = options.name or filenames[0]
+            savedpoints = make_lines({'points': savedpoints, 'tags': tags},
+                                     precision='s').splitlines()
+        lines += savedpoints
+    return lines
+
+
+class Breaker(object):
+    """Circuit breaker protecting InfluxDB calls
+
+    After a failure, InfluxDB is not contacted until retry_at, the delay
+    doubles after each consecutive failure, up to max_backoff, with
+    jitter. State is kept in status, so it persists across runs.
+    """
+    def __init__(self, status, backoff, max_backoff):
+        if 'breaker' not in status:
+            status['breaker'] = {'failures': 0, 'retry_at': 0}
+        self.state = status['breaker']
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+
+    def closed(self):
+        return not self.state['failures']
+
+    def allow(self):
+        return self.closed() or time() >= self.state['retry_at']
+
+    def success(self):
+        with self.lock:
+            if self.state['failures']:
+                logger.info("InfluxDB is back after %d failures" %
+                            self.state['failures'])
+            self.state['failures'] = 0
+            self.state['retry_at'] = 0
+
+    def failure(self):
+        with self.lock:
+            self.state['failures'] += 1
+            delay = min(self.max_backoff,
+                        self.backoff * 2 ** (self.state['failures'] - 1))
+            delay *= random.uniform(0.5, 1.0)
+            self.state['retry_at'] = time() + delay
+            logger.warning("InfluxDB failure %d, not trying again for %ds" %
+                           (self.state['failures'], delay))
+
+
+class Sender(object):
+    """Sends batches of points to InfluxDB from background threads
+
+    Batches go through a bounded queue, so parsing goes on while previous
+    batches are written, and blocks when senders lag behind. Each thread
+    has its own client, hence its own keep-alive session, so up to
+    --influx-senders batches are in flight. Batches failing to be sent are
+    spooled, spooled batches are removed from spool once sent. While the
+    breaker is open, batches are spooled without trying to send them. In
+    dry run mode, batches are only printed, InfluxDB, breaker and spool are
+    left alone.
+    """
+    def __init__(self, clients, spool, breaker, options):
+        self.options = options
+        self.clients = clients
+        self.spool = spool
+        self.breaker = breaker
+        # database created
+        self.ready = False
+        self.queue = queue.Queue(options.send_queue_size)
+        self.lock = threading.Lock()
+        self.failed = 0
+        self.threads = []
+        for client in clients:
+            thread = threading.Thread(target=self._run, args=(client, ))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _run(self, client):
+        while True:
+            item = self.queue.get()
             try:
-                shutil.copy2(self.main, self.tmp)
-                logger.debug("main2tmp(): Copied %r to %r" % (self.main, self.tmp))
+                if item is None:
+                    return
+                self._send(client, *item)
             except Exception as e:
-                logger.error("main2tmp(): failed: %r -> %r %s" % (self.main,
-                                                                 self.tmp,
-                                                                 str(e)))
-                raise
-
-    def remove_main(self):
-        self.main2old()
-        self.tmpclean()
+                # the thread goes on, or queue.join() and put() would wait
+                # forever, the batch counts as failed
+                msg = "Influx send: unexpected exception at %s: %s" % (lineno(), e)
+                traceback.print_exc()
+                logger.error(msg)
+                with self.lock:
+                    self.failed += len(item[1])
+            finally:
+                self.queue.task_done()
+
+    def _send(self, client, segment, batch):
+        if self.options.dry_run:
+            influxdb_send(client, batch, self.options)
+            return
+        if not self.breaker.closed():
+            if segment is None:
+                self.spool.append(batch)
+                with self.lock:
+                    self.failed += len(batch)
+            return
+        start = time()
         try:
-            os.remove(self.main)
-            logger.debug("remove_main(): Removed %r" % (self.main))
+            if self.options.simulate_send_failure:
+                raise Exception('Simulating send failure')
+            influxdb_send(client, batch, self.options)
         except Exception as e:
-            logger.error("remove_main(): failed: %r %s" % (self.main, str(e)))
-            pass
+            runstats.add('send', time() - start)
+            self.breaker.failure()
+            if segment is not None:
+                msg = "Influx send failed again: %s: %s" % (lineno(), e)
+            else:
+                msg = "Influx send: Exception caught at %s: %s" % (lineno(), e)
+            print(msg)
+            traceback.print_exc()
+            logger.error(msg)
+            if segment is None:
+                self.spool.append(batch)
+                with self.lock:
+                    self.failed += len(batch)
+        else:
+            runstats.add('send', time() - start)
+            if segment is not None:
+                self.spool.remove(segment)
+
+    def connect(self):
+        """Returns True if InfluxDB can be used: breaker is closed, or it is
+        time to retry and a single ping succeeds. Database is set up on
+        first success."""
+        if self.options.dry_run:
+            return True
+        if not self.breaker.allow():
+            return False
+        client = self.clients[0]
+        try:
+            if not self.breaker.closed():
+                if self.options.simulate_send_failure:
+                    raise Exception('Simulating send failure (ping)')
+                client.request(url='ping', expected_response_code=204)
+            if not self.ready:
+                influxdb_setup(client, self.options)
+                self.ready = True
+        except Exception as e:
+            msg = "InfluxDB unreachable: %s: %s" % (lineno(), e)
+            print(msg)
+            logger.error(msg)
+            self.breaker.failure()
+            return False
+        self.breaker.success()
+        return True
+
+    def send(self, lines):
+        batch_size = self.options.influx_batch_size or len(lines)
+        for start in range(0, len(lines), batch_size):
+            self.queue.put((None, lines[start:start + batch_size]))
+
+    def send_after(self, lines):
+        """Waits until queued batches are sent, then sends lines, or spools
+        them behind pending spool batches, so they are written after those
+        too"""
+        self.queue.join()
+        if self.options.dry_run or not len(self.spool):
+            self.send(lines)
+            return
+        batch_size = self.options.influx_batch_size or len(lines)
+        for start in range(0, len(lines), batch_size):
+            self.spool.append(lines[start:start + batch_size])
+        with self.lock:
+            self.failed += len(lines)
+
+    def resend(self, segment):
+        try:
+            lines = self.spool.read(segment)
+        except (IOError, OSError, zlib.error) as e:
+            # it would fail again on each run, blocking segments behind it
+            logger.error("Dropping unreadable spool segment %s: %s" %
+                         (segment, e))
+            self.spool.remove(segment)
+            return
+        self.queue.put((segment, lines))
+
+    def flush(self):
+        """Waits until queued batches are sent, returns number of points
+        spooled meanwhile"""
+        self.queue.join()
+        with self.lock:
+            failed, self.failed = self.failed, 0
+        return failed
+
+    def close(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+def start_sender(spool, status, options):
+    if options.dry_run:
+        senders = 1
+    else:
+        senders = max(1, options.influx_senders)
+    clients = [influxdb_client(options) for i in range(senders)]
+    breaker = Breaker(status, options.breaker_backoff,
+                      options.breaker_max_backoff)
+    return Sender(clients, spool, breaker, options)
+
+
+class LogFile(object):
+    """A log file being followed, with its own status and tags"""
+    def __init__(self, filename, status):
+        self.filename = filename
+        if filename not in status['files']:
+            status['files'][filename] = {
+                'offset': None,
+                'last_msec': 0,
+                'leftover': None,
+            }
+        self.status = status['files'][filename]
+        setup_rollups(self.status, status, options)
+        setup_corrections(self.status, options)
+        setup_topk(self.status, options)
+        touch_file(filename, self.status, 'rollups', 'corrections', 'topk')
+        if options.name and len(filenames) == 1:
+            name = options.name
+        else:
+            name = filename
+        self.tags = global_tags(options)
+        self.tags['name'] = name
+        self.encoder = LineEncoder(self.tags, options.consolidated)
+        self.tailer = Tailer(filename, self.status['offset'])
 
+    def close(self):
+        self.tailer.close()
 
-def read_config(conf_path):
-    with open(conf_path, 'r') as f:
-        return json.load(f)
+
+def open_logfiles(logfiles, status):
+    """Appends LogFile objects for new files matching options.file"""
+    known = set(logfile.filename for logfile in logfiles)
+    for filename in expand_files(options.file):
+        if filename not in known:
+            logfiles.append(LogFile(filename, status))
+
+
+def send_rollups(filestatus, encoder, sender, status):
+    """Sends windows of rollups of a log file ready to be sent"""
+    for rollup in filestatus['rollups'].values():
+        ready = rollup.pop_ready()
+        if ready is None:
+            continue
+        with runstats.timer('encode'):
+            lines = encoder.encode(ready, status, rollup.seconds, rollup.prefix)
+        sender.send(lines)
+
+
+def parse_and_send(logfiles, sender, status, options):
+    """Parses all log files, points are sent as soon as enough buckets are
+    processed, returns once all are sent"""
+    parsed_lines = 0
+    skipped_lines = 0
+    if not sender.connect():
+        logger.info("InfluxDB unavailable, parsing and spooling only, "
+                    "%d bytes in spool" % spool.size())
+    elif len(spool) and not options.dry_run:
+        segments = spool.oldest(options.spool_replay_size)
+        logger.info("Trying to send %d spooled batches out of %d" %
+                    (len(segments), len(spool)))
+        for segment in segments:
+            sender.resend(segment)
+    for logfile in logfiles:
+        def flush(mbs, encoder=logfile.encoder,
+                  corrections=logfile.status.get('corrections'),
+                  filename=logfile.filename, filestatus=logfile.status):
+            if mbs:
+                # changed in place as buckets are processed
+                touch_file(filename, filestatus, 'corrections', 'rollups',
+                           'topk')
+            with runstats.timer('encode'):
+                lines = encoder.encode(mbs, status)
+            if corrections is not None and corrections.pop_corrected():
+                # corrected buckets are written after their previous points
+                sender.send_after(lines)
+            else:
+                sender.send(lines)
+        mbs, leftover, last_msec, parsed, skipped, late = \
+            parsefile(logfile.tailer, status, logfile.status, options, flush)
+        logfile.status['leftover'] = leftover
+        logfile.status['last_msec'] = last_msec
+        touch_file(logfile.filename, logfile.status, 'leftover', 'last_msec',
+                   'sample_rate')
+        if parsed:
+            # changed in place by parsed lines
+            touch_file(logfile.filename, logfile.status, 'buckets', 'topk')
+        logfile.parsed = parsed
+        runstats.count(logfile.filename, parsed, skipped, late)
+        if profiler is not None:
+            profiler.sample()
+        parsed_lines += parsed
+        skipped_lines += skipped
+        flush(mbs)
+        send_rollups(logfile.status, logfile.encoder, sender, status)
+
+    failed = sender.flush()
+    if failed:
+        logger.info("Failed to send, %d points spooled for later, %d bytes in spool" %
+                    (failed, spool.size()))
+    return (parsed_lines, skipped_lines)
+
+
+def internal_lines(logfiles, options):
+    """Returns self metrics since last reset as line protocol lines, a
+    point per log file, and one for the whole run"""
+    now = time()
+    lines = []
+    for logfile in logfiles:
+        parsed, skipped, late = runstats.lines.get(logfile.filename, (0, 0, 0))
+        fields = {
+            'parsed_lines': parsed,
+            'skipped_lines': skipped,
+            'late_lines': late,
+            'sample_rate': logfile.status.get('sample_rate', 1),
+            'leftover_buckets': len(logfile.status['leftover'] or ()),
+            'bytes_behind': logfile.tailer.bytes_behind(),
+        }
+        if logfile.status['last_msec']:
+            fields['lag_seconds'] = now - logfile.status['last_msec']
+        lines.append(logfile.encoder.point(internal_measurement, fields,
+                                           int(now)))
+    fields = dict(('%s_seconds' % stage, seconds)
+                  for stage, seconds in runstats.seconds.items())
+    fields['run_seconds'] = now - runstats.start
+    fields['spool_bytes'] = spool.size()
+    fields['spool_batches'] = len(spool)
+    encoder = LineEncoder(global_tags(options))
+    lines.append(encoder.point(internal_measurement, fields, int(now)))
+    return lines
+
+
+def send_runstats(logfiles, sender, options):
+    """Sends self metrics, and starts measuring again"""
+    if options.internal_metrics:
+        sender.send(internal_lines(logfiles, options))
+    runstats.reset()
+
+
+def collapsed_stacks(stats, min_share=0.0001):
+    """Returns cProfile stats as collapsed stacks (flamegraph.pl input),
+    microseconds per stack
+
+    cProfile only records caller/callee pairs, time of a function is split
+    between its callers as measured, and between paths leading to a caller
+    in proportion of the time of each path. Paths taking less than
+    min_share of total time are cut.
+    """
+    def frame(func):
+        filename, line, name = func
+        if filename == '~':
+            # builtin
+            return name
+        return '%s (%s:%d)' % (name, os.path.basename(filename), line)
+
+    callees = defaultdict(dict)
+    for func, (cc, nc, tt, ct, callers) in stats.items():
+        for caller, edge in callers.items():
+            callees[caller][func] = edge[3]
+    roots = [func for func, value in stats.items() if not value[4]]
+    total = sum(stats[func][3] for func in roots)
+    stacks = defaultdict(float)
+
+    def walk(func, path, stack, seconds):
+        tt, ct = stats[func][2:4]
+        ratio = seconds / ct if ct else 0.0
+        stacks[stack] += tt * ratio
+        for callee, edge_ct in callees[func].items():
+            share = edge_ct * ratio
+            if callee in path or share < total * min_share:
+                # recursion is shown at first level only
+                continue
+            path.add(callee)
+            walk(callee, path, stack + ';' + frame(callee), share)
+            path.discard(callee)
+
+    for func in roots:
+        walk(func, set([func]), frame(func), stats[func][3])
+    return ['%s %d' % (stack, seconds * 1000000)
+            for stack, seconds in sorted(stacks.items())
+            if seconds >= 0.000001]
+
+
+class Profiler(object):
+    """CPU (cProfile) and/or memory (tracemalloc) profile of a run
+
+    stop() writes files named after prefix and start time:
+    .prof (pstats dump), .collapsed (flamegraph.pl input), and
+    .allocations (top allocation sites, python 3 only), taken at the
+    sample() which saw most memory in use.
+    Only the main process is profiled, not catch-up workers.
+    """
+    def __init__(self, kind, prefix, top=50):
+        self.cpu = kind in ('cpu', 'all')
+        self.memory = kind in ('memory', 'all')
+        if self.memory and tracemalloc is None:
+            logger.warning("Memory profile needs python 3, skipped")
+            self.memory = False
+        self.prefix = prefix
+        self.top = top
+        self.profile = None
+
+    def start(self):
+        self.started = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+        if self.memory:
+            tracemalloc.start()
+            self.snapshot = None
+            self.sampled = 0
+        if self.cpu:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def sample(self):
+        """Keeps a snapshot of allocations if more memory is in use than at
+        previous samples"""
+        if not self.memory:
+            return
+        current = tracemalloc.get_traced_memory()[0]
+        if current > self.sampled:
+            self.snapshot = tracemalloc.take_snapshot()
+            self.sampled = current
+
+    def stop(self):
+        path = '%s.%s' % (self.prefix, self.started)
+        if self.cpu:
+            self.profile.disable()
+            self.profile.dump_stats(path + '.prof')
+            lines = collapsed_stacks(pstats.Stats(self.profile).stats)
+            with open(path + '.collapsed', 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            self.profile = None
+            logger.info("CPU profile written to %s.{prof,collapsed}" % path)
+        if self.memory:
+            self.sample()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            snapshot = self.snapshot.filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__)])
+            with open(path + '.allocations', 'w') as f:
+                f.write("peak=%d KiB, allocations in use when snapshot was taken=%d KiB\n" %
+                        (peak // 1024, self.sampled // 1024))
+                for stat in snapshot.statistics('lineno')[:self.top]:
+                    f.write("%s\n" % stat)
+            self.snapshot = None
+            logger.info("Top allocations written to %s.allocations" % path)
+
+# set by main() if --profile is used
+profiler = None
+
+
+class DaemonState(object):
+    stop = False
+
+def daemon_stop(signum, frame):
+    logger.info("Received signal %d, stopping" % signum)
+    DaemonState.stop = True
+
+def daemon(logfiles, sender, status, options):
+    """Follow log files until SIGTERM, keeping tailers, leftover buckets
+    and influxdb client in memory, status is checkpointed every
+    --daemon-checkpoint-interval seconds, new files matching globs are
+    picked up at this time too, if profiling, only the first interval is
+    profiled"""
+    global profiler
+    signal.signal(signal.SIGTERM, daemon_stop)
+    parsed_lines = 0
+    skipped_lines = 0
+    last_checkpoint = time()
+    while not DaemonState.stop:
+        parsed, skipped = parse_and_send(logfiles, sender, status, options)
+        parsed_lines += parsed
+        skipped_lines += skipped
+
+        if time() - last_checkpoint >= options.daemon_checkpoint_interval:
+            checkpoint(status)
+            last_checkpoint = time()
+            logger.debug("Checkpoint saved")
+            send_runstats(logfiles, sender, options)
+            open_logfiles(logfiles, status)
+            if profiler is not None:
+                profiler.stop()
+                profiler = None
+
+        rotated = False
+        for logfile in logfiles:
+            if not logfile.parsed and logfile.tailer.follow_rotation():
+                rotated = True
+        if not parsed and not rotated:
+            sleep(options.daemon_poll_interval)
+
+    return (parsed_lines, skipped_lines)
+
+
+def backfill_name(options):
+    """Returns name tag of points of --backfill archives, the one of the
+    live log, or None if it can't be guessed"""
+    if options.name:
+        return options.name
+    if len(filenames) == 1:
+        return filenames[0]
+    return None
+
+
+def backfill(sender, status, options):
+    """Parses --backfill archives as a single log, oldest first, buckets are
+    processed once a line --backfill-lookback buckets later is parsed, and
+    remaining ones at the end.
+    Offset in each archive and leftover buckets are checkpointed every
+    --daemon-checkpoint-interval seconds, once processed buckets are sent
+    (or spooled), so an interrupted backfill resumes where it stopped.
+    Archives already parsed are skipped."""
+    name = backfill_name(options)
+    if name not in status['files']:
+        status['files'][name] = {
+            'offset': None,
+            'last_msec': 0,
+            'leftover': None,
+        }
+    filestatus = status['files'][name]
+    archives = filestatus.setdefault('archives', dict())
+    setup_rollups(filestatus, status, options)
+    setup_topk(filestatus, options)
+    tags = global_tags(options)
+    tags['name'] = name
+    encoder = LineEncoder(tags, options.consolidated)
+
+    pending = [os.path.abspath(path) for path in options.backfill]
+    pending = [path for path in pending
+               if not archives.get(path, {}).get('done')]
+    if not pending:
+        logger.info("Backfill: all archives were parsed already")
+        return (0, 0)
+    pending.sort(key=archive_first_msec)
+    if not sender.connect():
+        logger.info("InfluxDB unavailable, parsing and spooling only, "
+                    "%d bytes in spool" % spool.size())
+
+    if filestatus['leftover'] is None:
+        filestatus['leftover'] = dict()
+    # on resume, lines of buckets processed already are too late, as in
+    # parsefile()
+    bucket_duration = status['bucket_duration']
+    if not filestatus['last_msec']:
+        ignore_before = 0
+    else:
+        ignore_before = (int(math.ceil(filestatus['last_msec'] / bucket_duration))
+                         - options.backfill_lookback) * bucket_duration
+    parser = LineParser(filestatus['leftover'], bucket_duration, ignore_before,
+                        filestatus['last_msec'], options.backfill_lookback,
+                        dict(), status, options.quiet,
+                        filestatus['topk'].get('vhost'),
+                        filestatus['topk'].get('upstream'),
+                        list(filestatus['rollups'].values()),
+                        options.engine)
+
+    def flush(force=False):
+        if not force and mbs_size(parser.mbs) < options.influx_batch_size:
+            return
+        with runstats.timer('encode'):
+            lines = encoder.encode(parser.mbs, status)
+        sender.send(lines)
+        parser.mbs = dict()
+        send_rollups(filestatus, encoder, sender, status)
+
+    def save():
+        flush(True)
+        failed = sender.flush()
+        if failed:
+            logger.info("Failed to send, %d points spooled for later" % failed)
+        filestatus['last_msec'] = parser.last_msec
+        touch_file(name, filestatus, 'leftover', 'buckets', 'last_msec',
+                   'archives', 'topk', 'rollups')
+        checkpoint(status)
+
+    last_checkpoint = time()
+    for path in pending:
+        progress = archives.setdefault(path, {'offset': 0, 'done': False})
+        logger.info("Backfill: parsing %s from offset %d" %
+                    (path, progress['offset']))
+        for offset, lines in runstats.timed('read', archive_batches(path, progress['offset'])):
+            with runstats.timer('parse'):
+                parser.parse(lines)
+            progress['offset'] = offset
+            flush()
+            if time() - last_checkpoint >= options.daemon_checkpoint_interval:
+                save()
+                last_checkpoint = time()
+        progress['done'] = True
+        save()
+
+    storage = parser.storage
+    for bucket in sorted(storage):
+        with runstats.timer('aggregate'):
+            process_bucket(bucket, storage, status, parser.mbs, parser.rollups)
+    save()
+    logger.info("Backfill: parsed %d lines, skipped %d" %
+                (parser.parsed_lines, parser.skipped_lines))
+    runstats.count(name, parser.parsed_lines, parser.skipped_lines,
+                   parser.late_lines)
+    return (parser.parsed_lines, parser.skipped_lines)
 
 
 description= \
@@ -687,348 +3926,408 @@ In addition of your usual access log, add something like:
 
 Note: first field in stats format declaration is a format version, it should be set to 1.
 
-"""
-
-defaults = {
-    'config': [],
-    'datacenter': '',
-    'dry_run': False,
-    'file': '',
-    'hostname': platform.node(),
-    'log_conf': None,
-    'log_dir': '',
-    'max_lines': 0,
-    'name': '',
-    'quiet': 0,
-    'workdir': '.',
-
-    'influx_batch_size': 500,
-    'influx_database': 'mbstats',
-    'influx_host': 'localhost',
-    'influx_password': 'root',
-    'influx_port': 8086,
-    'influx_timeout': 40,
-    'influx_username': 'root',
-
-    'bucket_duration': 60,
-    'debug': False,
-    'do_not_skip_to_end': False,
-    'influx_drop_database': False,
-    'locker': 'fcntl',
-    'lookback_factor': 2,
-    'send_failure_fifo_size': 30,
-    'simulate_send_failure': False,
-    'startover': False,
-    'syslog': False,
-}
-conf_parser = argparse.ArgumentParser(add_help=False)
-conf_parser.add_argument("-c", "--config", help="Specify json config file(s)",
-                         action='append', metavar="FILE")
-args, remaining_argv = conf_parser.parse_known_args()
-
-if args.config:
-    for conf_path in args.config:
-        defaults['config'].append(conf_path)
-        config = read_config(conf_path)
-        for k in config:
-            if k not in defaults:
-                continue
-            if k == 'config':
-                continue
-            defaults[k] = config[k]
-
-parser = argparse.ArgumentParser(description=description, epilog=epilog,
-                                 formatter_class=argparse.RawDescriptionHelpFormatter,
-                                 parents=[conf_parser], conflict_handler='resolve')
-parser.set_defaults(**defaults)
-
-required = parser.add_argument_group('required arguments')
-required.add_argument('-f', '--file',
-                      help="log file to process")
-
-common = parser.add_argument_group('common arguments')
-common.add_argument('-c', '--config', action='append', metavar='FILE',
-                    help="Specify json config file(s)")
-common.add_argument('-d', '--datacenter',
-                   help="string to use as 'dc' tag")
-common.add_argument('-H', '--hostname',
-                   help="string to use as 'host' tag")
-common.add_argument('-l', '--log-dir', action='store',
-                    help='Where to store the stats.parser logfile.  Default location is workdir')
-common.add_argument('-n', '--name',
-                   help="string to use as 'name' tag")
-common.add_argument('-m', '--max-lines', type=int,
-                    help="maximum number of lines to process")
-common.add_argument('-w', '--workdir',
-                   help="directory where offset/status are stored")
-common.add_argument('-y', '--dry-run', action='store_true',
-                    help='Parse the log file but send stats to standard output')
-common.add_argument('-q', '--quiet', action='count',
-                    help='Reduce verbosity / quiet mode')
-
-influx = parser.add_argument_group('influxdb arguments')
-influx.add_argument('--influx-host',
-                   help="influxdb host")
-influx.add_argument('--influx-port', type=int,
-                   help="influxdb port")
-influx.add_argument('--influx-username',
-                   help="influxdb username")
-influx.add_argument('--influx-password',
-                   help="influxdb password")
-influx.add_argument('--influx-database',
-                   help="influxdb database")
-influx.add_argument('--influx-timeout', type=int,
-                   help="influxdb timeout")
-influx.add_argument('--influx-batch-size', type=int,
-                   help="number of points to send per batch")
-
-expert = parser.add_argument_group('expert arguments')
-expert.add_argument('-D', '--debug', action='store_true',
-                    help="Enable debug mode")
-expert.add_argument('--influx-drop-database', action='store_true',
-                   help="drop existing InfluxDB database, use with care")
-expert.add_argument('--locker', choices=('fcntl', 'portalocker'),
-
-                    help="type of lock to use")
-expert.add_argument('--lookback-factor', type=int,
-                   help="number of buckets to wait before sending any data")
-expert.add_argument('--startover', action='store_true',
-                   help="ignore all status/offset, like a first run")
-expert.add_argument('--do-not-skip-to-end', action='store_true',
-                   help="do not skip to end on first run")
-expert.add_argument('--bucket-duration', type=int,
-                   help="duration for each bucket in seconds")
-expert.add_argument('--log-conf', action='store',
-                    help='Logging configuration file. None by default')
-expert.add_argument('--dump-config', action='store_true',
-                   help="dump config as json to stdout")
-expert.add_argument('--syslog', action='store_true',
-                    help="Log to syslog")
-expert.add_argument('--send-failure-fifo-size', type=int,
-                    help="Number of failed sends to backup")
-expert.add_argument('--simulate-send-failure', action='store_true',
-                    help="Simulate send failure for testing purposes")
-
-options = parser.parse_args(remaining_argv)
-if options.dump_config:
-    print(json.dumps(vars(options), indent=4, sort_keys=True))
-    sys.exit(0)
-#print(options)
-
-log_dir = options.log_dir
-if not log_dir:
-    log_dir = options.workdir
-
-logger = logging.getLogger('stats.parser')
-if options.syslog:
-    hdlr = logging.handlers.SysLogHandler(address='/dev/log', facility=logging.handlers.SysLogHandler.LOG_SYSLOG)
-    formatter = logging.Formatter('%(name)s: %(message)s')
-    hdlr.setFormatter(formatter)
-else:
-    # Logging infrastructure for use throughout the script.
-    # Uses appending log file, rotated at 100 MB, keeping 5.
-    if (not os.path.isdir(log_dir)):
-        os.mkdir(log_dir)
-    formatter = logging.Formatter('%(asctime)s %(process)-5s %(levelname)-8s %(message)s')
-    hdlr = logging.handlers.RotatingFileHandler('%s/stats.parser.log' % log_dir, 'a', 100 * 1024 * 1024, 5)
-    hdlr.setFormatter(formatter)
-
-logger.addHandler(hdlr)
-logger.setLevel(logging.INFO)
-
-if (options.log_conf):
-     logging.config.fileConfig(options.log_conf)
-
-if (options.debug):
-    logger.setLevel(logging.DEBUG)
-
-if not options.quiet:
-    logger.info("Starting with options %r", vars(options))
-elif options.quiet == 1:
-    logger.info("Starting")
-
-filename = options.file
-if not filename:
-    parser.print_usage()
-    sys.exit(1)
-
-if options.locker == 'portalocker':
-    import portalocker
-    lock_exception_klass = portalocker.LockException
-else:
-    import fcntl
-    lock_exception_klass = IOError
-
-
-
-workdir = os.path.abspath(options.workdir)
-safefile = SafeFile(workdir, filename)
-files = {
-    'offset':   safefile.suffixed('offset'),
-    'status':   safefile.suffixed('status'),
-    'lock':     safefile.suffixed('lock')
-}
-
-# Check for lock file so we don't run multiple copies of the same parser
-# simultaneuosly. This will happen if the log parsing takes more time than
-# the cron period.
-try:
-    lockfile = start_locking(files['lock'].main)
-except LockingError as e:
-    msg = "Locking error: %s" % e
-    print(msg)
-    logger.warning(msg)
-    sys.exit(1)
-
-def cleanup():
-    files['offset'].tmpclean()
-    files['status'].tmpclean()
-    end_locking(lockfile, files['lock'].main)
-
-def finalize():
-    files['offset'].tmp2main()
-    files['status'].tmp2main()
+Other formats can be declared in json config, as lists of field names, like:
+  "log_formats": {"2": ["version", "msec", "vhost", "status", "ssl_protocol"]}
+Lines are parsed according to their version, so formats can be changed
+without losing lines. Formats start with version and msec, and need vhost and
+status, missing fields are parsed as absent ('-', or 0 for sizes), and
+fields not listed above are skipped, unless declared with their type and
+whether they are InfluxDB tags or fields, like:
+  {"name": "ssl_protocol", "influx": "tag", "type": "str"}
+  {"name": "ssl_handshake_time", "influx": "field", "type": "float"}
+Tags (str, int or float) are added to tags of request and upstream measurements,
+and left out for lines of formats lacking them. Fields (int or float) are summed
+per requests tags, as NAME_sum and NAME_mean measurements ('-' is absent).
 
+"""
 
-if options.startover:
-    files['offset'].remove_main()
-    files['status'].remove_main()
+def parse_options(argv=None):
+    """Returns options from config file(s) and command line"""
+    defaults = {
+        'backfill': [],
+        'config': [],
+        'consolidated': False,
+        'daemon': False,
+        'datacenter': '',
+        'dry_run': False,
+        'file': [],
+        'hostname': platform.node(),
+        'log_conf': None,
+        'log_dir': '',
+        'log_formats': {},
+        'max_lines': 0,
+        'name': '',
+        'quiet': 0,
+        'rollups': '',
+        'workdir': '.',
+
+        'influx_batch_size': 500,
+        'influx_database': 'mbstats',
+        'influx_gzip': True,
+        'influx_host': 'localhost',
+        'influx_password': 'root',
+        'influx_port': 8086,
+        'influx_senders': 2,
+        'influx_timeout': 40,
+        'influx_username': 'root',
+        'internal_metrics': True,
+
+        'backfill_batch_size': 10000,
+        'backfill_lookback': 60,
+        'breaker_backoff': 30,
+        'breaker_max_backoff': 3600,
+        'bucket_duration': 60,
+        'catchup_threshold': 64*1024*1024,
+        'catchup_workers': 0,
+        'daemon_checkpoint_interval': 60,
+        'daemon_poll_interval': 1.0,
+        'debug': False,
+        'do_not_skip_to_end': False,
+        'engine': 'python',
+        'first_run_buckets': 0,
+        'grace_buckets': 0,
+        'influx_drop_database': False,
+        'locker': 'fcntl',
+        'lookback_factor': 2,
+        'max_sample_rate': 100,
+        'max_upstreams': 0,
+        'max_vhosts': 0,
+        'profile': '',
+        'profile_top': 50,
+        'sample_lag': 0,
+        'sample_threshold': 0,
+        'spool_max_size': 256*1024*1024,
+        'spool_replay_size': 1024*1024,
+        'send_queue_size': 8,
+        'simulate_send_failure': False,
+        'startover': False,
+        'syslog': False,
+    }
+    conf_parser = argparse.ArgumentParser(add_help=False)
+    conf_parser.add_argument("-c", "--config", help="Specify json config file(s)",
+                             action='append', metavar="FILE")
+    args, remaining_argv = conf_parser.parse_known_args(argv)
+
+    if args.config:
+        for conf_path in args.config:
+            defaults['config'].append(conf_path)
+            config = read_config(conf_path)
+            for k in config:
+                if k not in defaults:
+                    continue
+                if k == 'config':
+                    continue
+                defaults[k] = config[k]
+
+    parser = argparse.ArgumentParser(description=description, epilog=epilog,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     parents=[conf_parser], conflict_handler='resolve')
+    parser.set_defaults(**defaults)
+
+    required = parser.add_argument_group('required arguments')
+    required.add_argument('-f', '--file', nargs='+', metavar='FILE',
+                          help="log file(s) to process, globs are expanded (quote them)")
+
+    common = parser.add_argument_group('common arguments')
+    common.add_argument('-c', '--config', action='append', metavar='FILE',
+                        help="Specify json config file(s)")
+    common.add_argument('--daemon', action='store_true',
+                        help="keep running, following the log file, instead of exiting at its end")
+    common.add_argument('--backfill', nargs='+', metavar='ARCHIVE',
+                        help="parse plain or gzipped archives of the log named by -n or -f instead of following it, an interrupted backfill resumes where it stopped")
+    common.add_argument('-d', '--datacenter',
+                       help="string to use as 'dc' tag")
+    common.add_argument('-H', '--hostname',
+                       help="string to use as 'host' tag")
+    common.add_argument('-l', '--log-dir', action='store',
+                        help='Where to store the stats.parser logfile.  Default location is workdir')
+    common.add_argument('-n', '--name',
+                       help="string to use as 'name' tag, if only one file is processed, file path is used otherwise")
+    common.add_argument('-m', '--max-lines', type=int,
+                        help="maximum number of lines to process")
+    common.add_argument('-w', '--workdir',
+                       help="directory where offset/status are stored")
+    common.add_argument('-y', '--dry-run', action='store_true',
+                        help='Parse the log file but send stats to standard output')
+    common.add_argument('-q', '--quiet', action='count',
+                        help='Reduce verbosity / quiet mode')
+
+    influx = parser.add_argument_group('influxdb arguments')
+    influx.add_argument('--influx-host',
+                       help="influxdb host")
+    influx.add_argument('--influx-port', type=int,
+                       help="influxdb port")
+    influx.add_argument('--influx-username',
+                       help="influxdb username")
+    influx.add_argument('--influx-password',
+                       help="influxdb password")
+    influx.add_argument('--influx-database',
+                       help="influxdb database")
+    influx.add_argument('--influx-timeout', type=int,
+                       help="influxdb timeout")
+    influx.add_argument('--influx-batch-size', type=int,
+                       help="number of points to send per batch")
+    influx.add_argument('--consolidated', action='store_true',
+                       help="write values sharing tags as fields of 'requests' and 'upstreams' measurements, see grafana-mbstats-consolidated.json")
+    influx.add_argument('--rollups', metavar='DURATIONS',
+                       help="also write sums over longer durations, comma separated (like 5m,1h,1d), each one to measurements prefixed with '%s'" % (rollup_prefix % 'DURATION'))
+    influx.add_argument('--influx-senders', type=int,
+                       help="number of batches sent concurrently")
+    influx.add_argument('--influx-no-gzip', action='store_false', dest='influx_gzip',
+                       help="do not compress points sent to influxdb")
+    influx.add_argument('--no-internal-metrics', action='store_false', dest='internal_metrics',
+                       help="do not send %s measurement (time spent per stage, lag, ...)" % internal_measurement)
+
+    expert = parser.add_argument_group('expert arguments')
+    expert.add_argument('-D', '--debug', action='store_true',
+                        help="Enable debug mode")
+    expert.add_argument('--influx-drop-database', action='store_true',
+                       help="drop existing InfluxDB database, use with care")
+    expert.add_argument('--locker', choices=('fcntl', 'portalocker'),
+
+                        help="type of lock to use")
+    expert.add_argument('--lookback-factor', type=int,
+                       help="number of buckets to wait before sending any data")
+    expert.add_argument('--grace-buckets', type=int,
+                       help="keep the last N buckets sent, so lines coming later than lookback factor correct them (they are sent again, counted as late_lines), older lines are skipped")
+    expert.add_argument('--startover', action='store_true',
+                       help="ignore all status/offset, like a first run")
+    expert.add_argument('--do-not-skip-to-end', action='store_true',
+                       help="do not skip to end on first run")
+    expert.add_argument('--first-run-buckets', type=int,
+                       help="on first run, start N buckets before end of file instead of skipping to end")
+    expert.add_argument('--max-vhosts', type=int,
+                       help="track at most N vhosts, others are reported as '%s', 0 (default) for no limit" % other_tag)
+    expert.add_argument('--max-upstreams', type=int,
+                       help="track at most N upstreams, others are reported as '%s', 0 (default) for no limit" % other_tag)
+    expert.add_argument('--bucket-duration', type=int,
+                       help="duration for each bucket in seconds")
+    expert.add_argument('--log-conf', action='store',
+                        help='Logging configuration file. None by default')
+    expert.add_argument('--dump-config', action='store_true',
+                       help="dump config as json to stdout")
+    expert.add_argument('--syslog', action='store_true',
+                        help="Log to syslog")
+    expert.add_argument('--spool-max-size', type=int,
+                        help="maximum size in bytes of points kept on disk after failed sends, oldest are dropped")
+    expert.add_argument('--spool-replay-size', type=int,
+                        help="maximum size in bytes of spooled points to resend per run")
+    expert.add_argument('--send-queue-size', type=int,
+                        help="number of batches waiting to be sent before parsing blocks")
+    expert.add_argument('--breaker-backoff', type=int,
+                        help="seconds to wait before contacting influxdb again after a failure, doubled on each consecutive failure")
+    expert.add_argument('--breaker-max-backoff', type=int,
+                        help="maximum seconds to wait before contacting influxdb again")
+    expert.add_argument('--simulate-send-failure', action='store_true',
+                        help="Simulate send failure for testing purposes")
+    expert.add_argument('--catchup-threshold', type=int,
+                        help="parse pending lines with a pool of processes if more than N bytes are pending, 0 to disable")
+    expert.add_argument('--catchup-workers', type=int,
+                        help="number of processes used to catch up, 0 for number of CPUs")
+    expert.add_argument('--sample-threshold', type=int,
+                        help="when more than N bytes are pending, parse only 1 line in (pending / N), its values counted as many times (sample_rate field of points and of %s), so stats stay current when falling behind, 0 to disable" % internal_measurement)
+    expert.add_argument('--sample-lag', type=int,
+                        help="when the last line parsed is more than N seconds old, parse only 1 line in (lag / N), 0 to disable")
+    expert.add_argument('--max-sample-rate', type=int,
+                        help="parse at least 1 line in N when sampling")
+    expert.add_argument('--engine', choices=('python', 'numpy'),
+                        help="parse big blocks of lines (catch-up, backfill, busy logs) column by column with NumPy, results are the same")
+    expert.add_argument('--daemon-checkpoint-interval', type=int,
+                        help="daemon and backfill modes: save offset/status every N seconds")
+    expert.add_argument('--backfill-lookback', type=int,
+                        help="backfill mode: process a bucket once a line N buckets later is parsed")
+    expert.add_argument('--backfill-batch-size', type=int,
+                        help="backfill mode: number of points to send per batch")
+    expert.add_argument('--daemon-poll-interval', type=float,
+                        help="daemon mode: seconds to wait for new lines at end of file")
+    expert.add_argument('--profile', choices=('cpu', 'memory', 'all'),
+                        help="profile the run (first checkpoint interval in daemon mode), cpu profile is written as pstats dump and collapsed stacks, memory one (python 3 only) as top allocation sites, files are written to workdir")
+    expert.add_argument('--profile-top', type=int,
+                        help="number of allocation sites written by memory profile")
+
+
+    options = parser.parse_args(remaining_argv)
+    # from json config
+    if not isinstance(options.file, list):
+        options.file = [options.file] if options.file else []
+    if not isinstance(options.backfill, list):
+        options.backfill = [options.backfill] if options.backfill else []
+    return (parser, options)
+
+
+def main():
+    global options, filenames, files, journal, spool, lockfile, logfiles, sender
+    global profiler
+    global portalocker, fcntl, lock_exception_klass
+    parser, options = parse_options()
+    try:
+        parse_rollups(options.rollups, options.bucket_duration)
+        setup_log_formats(options.log_formats)
+    except ValueError as e:
+        parser.error(str(e))
+    if options.dump_config:
+        print(json.dumps(vars(options), indent=4, sort_keys=True))
+        sys.exit(0)
+    #print(options)
+
+    log_dir = options.log_dir
+    if not log_dir:
+        log_dir = options.workdir
+
+    if options.syslog:
+        hdlr = logging.handlers.SysLogHandler(address='/dev/log', facility=logging.handlers.SysLogHandler.LOG_SYSLOG)
+        formatter = logging.Formatter('%(name)s: %(message)s')
+        hdlr.setFormatter(formatter)
+    else:
+        # Logging infrastructure for use throughout the script.
+        # Uses appending log file, rotated at 100 MB, keeping 5.
+        if (not os.path.isdir(log_dir)):
+            os.mkdir(log_dir)
+        formatter = logging.Formatter('%(asctime)s %(process)-5s %(levelname)-8s %(message)s')
+        hdlr = logging.handlers.RotatingFileHandler('%s/stats.parser.log' % log_dir, 'a', 100 * 1024 * 1024, 5)
+        hdlr.setFormatter(formatter)
+
+    logger.addHandler(hdlr)
+    logger.setLevel(logging.INFO)
+
+    if (options.log_conf):
+         logging.config.fileConfig(options.log_conf)
+
+    if (options.debug):
+        logger.setLevel(logging.DEBUG)
+
+    if not options.quiet:
+        logger.info("Starting with options %r", vars(options))
+    elif options.quiet == 1:
+        logger.info("Starting")
+
+    if options.engine == 'numpy' and numpy is None:
+        parser.error("--engine numpy needs NumPy")
+
+    filenames = expand_files(options.file)
+    if options.backfill:
+        if backfill_name(options) is None:
+            parser.error("--backfill needs -n or a single -f, to name points as the live log")
+        # bigger batches, written while nothing is waiting for them
+        options.influx_batch_size = options.backfill_batch_size
+    elif not filenames:
+        parser.print_usage()
+        sys.exit(1)
+
+    if options.locker == 'portalocker':
+        import portalocker
+        lock_exception_klass = portalocker.LockException
+    else:
+        import fcntl
+        lock_exception_klass = IOError
+
+
+
+    workdir = os.path.abspath(options.workdir)
+    # state is identified by files as given, so new files matching a glob are
+    # handled by the same journal
+    identifier = ' '.join(options.file)
+    if options.backfill:
+        # own state and lock, so the live log is parsed meanwhile
+        identifier = 'backfill'
+    if len(identifier) > 200:
+        identifier = hashlib.md5(identifier.encode('utf-8')).hexdigest()
+    safefile = SafeFile(workdir, identifier)
+    files = {
+        'journal':  safefile.suffixed('journal'),
+        # only read to import state saved by previous versions
+        'offset':   safefile.suffixed('offset'),
+        'status':   safefile.suffixed('status'),
+        'lock':     safefile.suffixed('lock'),
+        'spool':    safefile.suffixed('spool'),
+        'profile':  safefile.suffixed('profile'),
+    }
 
-parsed_lines = 0
-skipped_lines = 0
-res = False
-try:
-    influxdb = influxdb_client(options)
+    # Check for lock file so we don't run multiple copies of the same parser
+    # simultaneuosly. This will happen if the log parsing takes more time than
+    # the cron period.
+    try:
+        lockfile = start_locking(files['lock'].main)
+    except LockingError as e:
+        msg = "Locking error: %s" % e
+        print(msg)
+        logger.warning(msg)
+        sys.exit(1)
 
-    files['offset'].main2tmp()
+    journal = Journal(files['journal'].main)
+    spool = Spool(files['spool'].main, options.spool_max_size)
 
-    pygtail = Pygtail(filename, offset_file=files['offset'].tmp)
+    if options.startover:
+        files['journal'].remove_main()
+        files['offset'].remove_main()
+        files['status'].remove_main()
 
+    parsed_lines = 0
+    skipped_lines = 0
+    logfiles = []
+    sender = None
+    res = False
+    if options.profile:
+        profiler = Profiler(options.profile, files['profile'].main,
+                            options.profile_top)
+        profiler.start()
     try:
-        status = load_obj(files['status'].main)
-    except IOError:
-        status = {}
-
-    save = False
-    if not 'last_msec' in status:
-        status['last_msec'] = 0
-        save = True
-    if not 'leftover' in status:
-        status['leftover'] = None
-        save = True
-    if not 'bucket_duration' in status:
-        status['bucket_duration'] = options.bucket_duration
-        save = True
-    if not 'lookback_factor' in status:
-        status['lookback_factor'] = options.lookback_factor
-        save = True
-    if not 'saved_points' in status:
-        status['saved_points'] = deque([], options.send_failure_fifo_size)
-        save = True
-    if save:
-        save_obj(status, files['status'].tmp)
-
-    if (status['leftover'] is not None and len(status['leftover']) > 0):
-        exit = False
-        msg = 'Error:'
-        if status['bucket_duration'] != options.bucket_duration:
-            msg += (" Bucket duration mismatch %d vs %d (set via option)" %
-                  (status['bucket_duration'], options.bucket_duration))
-            exit = True
-        if status['lookback_factor'] != options.lookback_factor:
-            msg += (" Lookback factor mismatch %d vs %d (set via option)" %
-                  (status['lookback_factor'], options.lookback_factor))
-            exit = True
-        if exit:
-            msg += (" If you know what you are doing, remove status file %s" % files['status'].main)
-            logger.error(msg)
+        with runstats.timer('status'):
+            if options.backfill:
+                status = load_backfill_status(options)
+            else:
+                status = load_status(options)
+        if not options.backfill:
+            open_logfiles(logfiles, status)
+        sender = start_sender(spool, status, options)
+
+        if options.backfill:
+            parsed_lines, skipped_lines = backfill(sender, status, options)
+        elif options.daemon:
+            parsed_lines, skipped_lines = daemon(logfiles, sender, status, options)
+        else:
+            parsed_lines, skipped_lines = parse_and_send(logfiles, sender, status, options)
+    except KeyboardInterrupt:
+        if options.quiet < 2:
+            msg = "Exiting on keyboard interrupt"
             print(msg)
-            sys.exit(1)
-
-    mbs, leftover, last_msec, parsed_lines,skipped_lines = parsefile(pygtail, status, options)
-    status['leftover'] = leftover
-    status['last_msec'] = last_msec
-
-    points = mbs2influx(mbs, status)
-    if points or status['saved_points']:
-        tags = {
-            'host': options.hostname,
-            'name': options.name or filename,
-        }
-        if options.datacenter:
-            tags['dc'] = options.datacenter
+            logger.info(msg)
+        retcode = 1
+    except SystemExit as e:
+        raise
+    except Exception as e:
+        msg = "Exception caught at %s: %s" % (lineno(), e)
+        print(msg)
+        traceback.print_exc()
+        logger.error(msg)
+        retcode = 1
+    else:
+        checkpoint(status)
+        send_runstats(logfiles, sender, options)
+        retcode = 0
+    finally:
+        if profiler is not None:
+            profiler.stop()
+        cleanup()
 
-        if status['saved_points']:
-            to_resend = list()
-            for savedpoints in status['saved_points']:
-                to_resend += savedpoints
-            try:
-                logger.info("Trying to send %d saved points" %
-                            len(to_resend))
-                if options.simulate_send_failure:
-                    raise Exception('Simulating send failure (resend)')
-                if influxdb_send(influxdb, to_resend, tags, options):
-                    status['saved_points'].clear()
-            except Exception as e:
-                msg = "Influx send failed again: %s: %s" % (lineno(), e)
-                print(msg)
-                traceback.print_exc()
-                logger.error(msg)
-                pass
+    if options.quiet < 2:
+        # Log the execution time
+        exec_time = round(time() - script_start_time, 1)
+        if parsed_lines:
+            mean_per_line = 1000000.0 * (exec_time / parsed_lines)
+        else:
+            mean_per_line = 0.0
+        logger.info("duration=%ss parsed=%d skipped=%d mean_per_line=%0.3fµs" %
+                    (exec_time, parsed_lines, skipped_lines, mean_per_line))
 
-        if points:
-            try:
-                if options.simulate_send_failure:
-                    raise Exception('Simulating send failure')
-                ret = influxdb_send(influxdb, points, tags, options)
-                if not ret:
-                    raise Exception('influx_send failed')
-            except Exception as e:
-                msg = "Influx send: Exception caught at %s: %s" % (lineno(), e)
-                print(msg)
-                traceback.print_exc()
-                logger.error(msg)
-                status['saved_points'].append(points)
-                logger.info("Failed to send, saving points for later %d/%d" %
-                            (len(status['saved_points']),
-                             options.send_failure_fifo_size))
-                pass
 
-    save_obj(status, files['status'].tmp)
-except KeyboardInterrupt:
-    if options.quiet < 2:
-        msg = "Exiting on keyboard interrupt"
-        print(msg)
-        logger.info(msg)
-    retcode = 1
-except SystemExit as e:
-    raise
-except Exception as e:
-    msg = "Exception caught at %s: %s" % (lineno(), e)
-    print(msg)
-    traceback.print_exc()
-    logger.error(msg)
-    retcode = 1
-else:
-    finalize()
-    retcode = 0
-finally:
-    cleanup()
-
-if options.quiet < 2:
-    # Log the execution time
-    exec_time = round(time() - script_start_time, 1)
-    if parsed_lines:
-        mean_per_line = 1000000.0 * (exec_time / parsed_lines)
-    else:
-        mean_per_line = 0.0
-    logger.info("duration=%ss parsed=%d skipped=%d mean_per_line=%0.3fµs" %
-                (exec_time, parsed_lines, skipped_lines, mean_per_line))
+    try:
+        end_locking(lockfile, files['lock'].main)
+    except:
+        pass
 
+    sys.exit(retcode)
 
-try:
-    end_locking(lockfile, files['lock'].main)
-except:
-    pass
 
-sys.exit(retcode)
+if __name__ == '__main__':
+    main()
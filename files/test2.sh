@@ -4,7 +4,7 @@ set -xe
 INTERPRETER=$1
 [ -z "$INTERPRETER" ] && INTERPRETER="python"
 
-STATSLOG_SOURCE=~/src/mbstats.testlogs/stats.log
+STATSLOG_SOURCE=${STATSLOG_SOURCE:-~/src/mbstats.testlogs/stats.log}
 NOW=$(date -u +'%FT%TZ')
 TESTTMPDIR=$(mktemp -d -t tmp.XXXXXXXXXX)
 function finish {
@@ -12,6 +12,12 @@ function finish {
 }
 trap finish EXIT
 
+if [ ! -f "$STATSLOG_SOURCE" ]; then
+  # no real log at hand, use synthetic lines
+  STATSLOG_SOURCE=$TESTTMPDIR/source.log
+  $INTERPRETER stats.loggen.py -n 6000000 --seed 1 -o $STATSLOG_SOURCE
+fi
+
 STATSLOG=$TESTTMPDIR/stats.log
 
 >$STATSLOG
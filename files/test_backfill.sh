@@ -0,0 +1,27 @@
+#!/bin/bash
+set -xe
+
+INTERPRETER=$1
+[ -z "$INTERPRETER" ] && INTERPRETER="python"
+
+TESTTMPDIR=$(mktemp -d -t tmp.XXXXXXXXXX)
+function finish {
+  rm -rf "$TESTTMPDIR"
+}
+trap finish EXIT
+
+# 2 hours of lines, a line per second
+$INTERPRETER stats.loggen.py -n 7200 --rate 1 --start 1500000000 --seed 1 -o $TESTTMPDIR/source.log
+head -3600 $TESTTMPDIR/source.log | gzip > $TESTTMPDIR/stats.log.2.gz
+# next archive starts with lines of the last half hour of previous one
+tail -5400 $TESTTMPDIR/source.log > $TESTTMPDIR/stats.log.1
+
+CMD="$INTERPRETER stats.parser.py -f $TESTTMPDIR/stats.log -w $TESTTMPDIR -l $TESTTMPDIR -y --no-internal-metrics --backfill-lookback 5"
+$CMD --backfill $TESTTMPDIR/stats.log.2.gz > $TESTTMPDIR/first.out
+$CMD --backfill $TESTTMPDIR/stats.log.2.gz $TESTTMPDIR/stats.log.1 > $TESTTMPDIR/second.out
+
+# resumed backfill must not send again buckets sent before, only the last
+# 5 ones (--backfill-lookback) may get late lines
+LAST=$(awk '{print $NF}' $TESTTMPDIR/first.out | sort -n | tail -1)
+FIRST=$(awk '{print $NF}' $TESTTMPDIR/second.out | sort -n | head -1)
+[ "$FIRST" -gt $(($LAST - 5 * 60)) ] && echo "Testing backfill resume, SUCCESS"
@@ -0,0 +1,136 @@
+#!/bin/bash
+set -xe
+
+INTERPRETER=$1
+[ -z "$INTERPRETER" ] && INTERPRETER="python"
+
+TESTTMPDIR=$(mktemp -d -t tmp.XXXXXXXXXX)
+INFLUXPID=
+function finish {
+  [ -n "$INFLUXPID" ] && kill $INFLUXPID
+  rm -rf "$TESTTMPDIR"
+}
+trap finish EXIT
+
+# fake InfluxDB, appending lines written to $TESTTMPDIR/influx.out
+cat > $TESTTMPDIR/influx.py <<'EOF'
+import sys, zlib
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+class Handler(BaseHTTPRequestHandler):
+    def reply(self, code, body=b''):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.reply(204)
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        if not self.path.startswith('/write'):
+            return self.reply(200, b'{"results": [{"statement_id": 0}]}')
+        if self.headers.get('Content-Encoding') == 'gzip':
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        with open(sys.argv[2], 'ab') as f:
+            f.write(data)
+        self.reply(204)
+
+    def log_message(self, *args):
+        pass
+
+server = HTTPServer(('127.0.0.1', 0), Handler)
+with open(sys.argv[1], 'w') as f:
+    f.write(str(server.server_address[1]))
+server.serve_forever()
+EOF
+$INTERPRETER $TESTTMPDIR/influx.py $TESTTMPDIR/influx.port $TESTTMPDIR/influx.out &
+INFLUXPID=$!
+while [ ! -s $TESTTMPDIR/influx.port ]; do sleep 0.1; done
+PORT=$(cat $TESTTMPDIR/influx.port)
+
+# last point written per series and timestamp, as InfluxDB keeps it
+function delivered {
+  awk '{point[$1 " " $NF] = $0} END {for (k in point) print point[k]}' $TESTTMPDIR/influx.out | sort
+  rm -f $TESTTMPDIR/influx.out
+}
+
+$INTERPRETER stats.loggen.py -n 60000 --rate 50 --start 1500000000 --seed 1 --disorder 20 -o $TESTTMPDIR/source.log
+
+# runs the parser with workdir $1 on the first $2 lines of source log
+function run {
+  mkdir -p $TESTTMPDIR/$1
+  head -$2 $TESTTMPDIR/source.log > $TESTTMPDIR/$1/stats.log
+  $INTERPRETER stats.parser.py -f $TESTTMPDIR/$1/stats.log -w $TESTTMPDIR/$1 -l $TESTTMPDIR/$1 \
+    --name stats --do-not-skip-to-end --no-internal-metrics --influx-port $PORT \
+    --influx-senders 1 --breaker-backoff 0 "${@:3}"
+}
+
+run clean 20000
+run clean 40000
+run clean 60000
+delivered > $TESTTMPDIR/clean.out
+
+# crash while appending the last commit: tail of journal is incomplete,
+# and while compacting it: compacted file wasn't renamed
+run journal 20000
+run journal 40000
+JOURNAL=$(ls $TESTTMPDIR/journal/*_journal)
+truncate -s -10 $JOURNAL
+echo garbage > $JOURNAL.compact
+run journal 60000
+grep -q "discarding [0-9]* bytes of incomplete record" $TESTTMPDIR/journal/stats.parser.log
+# resumed from the first commit, instead of starting over
+[ $(grep -c "First run:" $TESTTMPDIR/journal/stats.parser.log) -eq 1 ]
+[ ! -e $JOURNAL.compact ]
+delivered > $TESTTMPDIR/journal.out
+diff $TESTTMPDIR/clean.out $TESTTMPDIR/journal.out && echo "Testing recovery of journal, SUCCESS"
+
+# InfluxDB failing: points are spooled, a segment per batch
+run spool 20000 --simulate-send-failure
+run spool 40000 --simulate-send-failure
+run spool 60000 --simulate-send-failure
+SPOOL=$(ls -d $TESTTMPDIR/spool/*_spool)
+SEGMENTS=$(ls $SPOOL | sort)
+[ $(echo "$SEGMENTS" | wc -l) -gt 10 ]
+
+# full spool: oldest segments are dropped, newest are kept whole
+SPOOLSIZE=$(cat $SPOOL/* | wc -c)
+run rotation 20000 --simulate-send-failure --spool-max-size $(($SPOOLSIZE / 4))
+run rotation 40000 --simulate-send-failure --spool-max-size $(($SPOOLSIZE / 4))
+run rotation 60000 --simulate-send-failure --spool-max-size $(($SPOOLSIZE / 4))
+grep -q "is full, dropped" $TESTTMPDIR/rotation/stats.parser.log
+KEPT=$(ls $TESTTMPDIR/rotation/*_spool | sort)
+[ "$KEPT" = "$(echo "$SEGMENTS" | tail -$(echo "$KEPT" | wc -l))" ]
+for segment in $KEPT; do
+  cmp <(gunzip -c $TESTTMPDIR/rotation/*_spool/$segment) <(gunzip -c $SPOOL/$segment)
+done
+echo "Testing rotation of spool, SUCCESS"
+
+# crash while writing a segment, and a segment corrupted on disk: its
+# points are lost, others are replayed in order, in bounded chunks
+CORRUPTED=$(echo "$SEGMENTS" | sed -n 5p)
+for segment in $SEGMENTS; do
+  if [ $segment = $CORRUPTED ]; then
+    gunzip -c $SPOOL/$segment > $TESTTMPDIR/lost.lp
+  else
+    gunzip -c $SPOOL/$segment
+  fi
+done > $TESTTMPDIR/spooled.lp
+truncate -s 20 $SPOOL/$CORRUPTED
+echo garbage > $SPOOL/99999999999999999999.lp.gz.tmp
+rm -f $TESTTMPDIR/influx.out
+for i in $(seq 1 100); do
+  [ -z "$(ls $SPOOL)" ] && break
+  run spool 60000 --spool-replay-size 100000
+done
+[ -z "$(ls $SPOOL)" ]
+grep -q "Dropping unreadable spool segment" $TESTTMPDIR/spool/stats.parser.log
+diff $TESTTMPDIR/spooled.lp $TESTTMPDIR/influx.out
+delivered > $TESTTMPDIR/spool.out
+sort $TESTTMPDIR/lost.lp | comm -23 $TESTTMPDIR/clean.out - | diff - $TESTTMPDIR/spool.out && echo "Testing replay of spool, SUCCESS"
@@ -0,0 +1,56 @@
+#!/bin/bash
+set -xe
+
+INTERPRETER=$1
+[ -z "$INTERPRETER" ] && INTERPRETER="python"
+
+TESTTMPDIR=$(mktemp -d -t tmp.XXXXXXXXXX)
+function finish {
+  rm -rf "$TESTTMPDIR"
+}
+trap finish EXIT
+
+STATSLOG=$TESTTMPDIR/stats.log
+
+# half of requests to 10.0.0.1 time out, their timings are absent ('-'),
+# 10.0.0.2 never answers
+for i in $(seq 1 600); do
+  echo "1|1500000001.$i|vhost.example.org|s|-|200|100|-|100|0.5|10.0.0.1:80|200|0.5|0.001|0.4"
+  echo "1|1500000002.$i|vhost.example.org|s|-|504|100|-|100|60.0|10.0.0.1:80|504|-|-|-"
+  echo "1|1500000003.$i|vhost.example.org|s|-|200|100|-|100|0.5|10.0.0.2:80, 10.0.0.1:80|502, 200|-, 0.5|-, 0.001|-, 0.4"
+done > $STATSLOG
+# moves the watermark, so the bucket above is processed
+echo "1|1500000300.000|vhost.example.org|s|-|200|100|-|100|0.5|-|-|-|-|-" >> $STATSLOG
+
+CMD="$INTERPRETER stats.parser.py -f $STATSLOG -w $TESTTMPDIR -l $TESTTMPDIR -y --no-internal-metrics --do-not-skip-to-end"
+$CMD > $TESTTMPDIR/python.out
+
+# absent timings are not counted as zeros in quantiles, the mean is
+# still over all hits
+grep -q "^upstreams_response_time_p50,.*upstream=10.0.0.1:80,.* value=0.5 " $TESTTMPDIR/python.out
+grep -q "^upstreams_header_time_p50,.*upstream=10.0.0.1:80,.* value=0.4 " $TESTTMPDIR/python.out
+grep -q "^upstreams_response_time_mean,.*upstream=10.0.0.1:80,.* value=0.333" $TESTTMPDIR/python.out
+echo "Testing quantiles with absent timings, SUCCESS"
+# upstreams with absent timings only have a mean, but no quantile
+grep -q "^upstreams_response_time_mean,.*upstream=10.0.0.2:80,.* value=0.0 " $TESTTMPDIR/python.out
+if grep -q "^upstreams_response_time_p50,.*upstream=10.0.0.2:80," $TESTTMPDIR/python.out; then
+  exit 1
+fi
+echo "Testing upstream without timings, SUCCESS"
+
+if $INTERPRETER -c 'import numpy' 2>/dev/null; then
+  $CMD --engine numpy --startover > $TESTTMPDIR/numpy.out
+  diff $TESTTMPDIR/python.out $TESTTMPDIR/numpy.out && echo "Testing numpy engine with absent timings, SUCCESS"
+fi
+
+# first run starting a few buckets back must send its first bucket whole,
+# though lines are logged up to 20s late
+DISORDERLOG=$TESTTMPDIR/disorder.log
+$INTERPRETER stats.loggen.py -n 30000 --rate 50 --start 1500000000 --seed 1 --disorder 20 -o $DISORDERLOG
+CMD="$INTERPRETER stats.parser.py -f $DISORDERLOG -w $TESTTMPDIR -l $TESTTMPDIR -y --no-internal-metrics --startover"
+$CMD --first-run-buckets 3 > $TESTTMPDIR/first_run.out
+$CMD --do-not-skip-to-end > $TESTTMPDIR/full.out
+FIRST=$(awk '{print $NF}' $TESTTMPDIR/first_run.out | sort -n | head -1)
+grep " $FIRST\$" $TESTTMPDIR/first_run.out | sort > $TESTTMPDIR/first_run.bucket
+grep " $FIRST\$" $TESTTMPDIR/full.out | sort > $TESTTMPDIR/full.bucket
+diff $TESTTMPDIR/first_run.bucket $TESTTMPDIR/full.bucket && echo "Testing first bucket of first run with unordered lines, SUCCESS"
@@ -1,10 +1,10 @@
 #!/bin/bash
 
 LOGDIR=/var/log/
-FILE=mywebsite.stats.log
+# one container can handle many files, glob is expanded by stats.parser.py
+FILE='*.stats.log'
 
-NAME=$(echo -n $FILE |sed 's/\.stats.log$//')
-CONTAINER_NAME=mbstats-$NAME
+CONTAINER_NAME=mbstats
 VOLUME_NAME=$CONTAINER_NAME
 
 docker volume create --driver local --name $VOLUME_NAME